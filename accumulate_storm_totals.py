@@ -0,0 +1,127 @@
+# Purpose: Storm total of the hourly NEXRAD rasters of a day without arcpy (replaces
+# reclass_rsters.py). The scan closest to every hour is read window by window inside the clip box,
+# negatives are set to 0 and the values are added in place to one float32 accumulator, so memory
+# holds one clipped scan and the sum
+
+import os
+import numpy as np
+from storm_stats_functions import data_dir, check_dir
+
+try:
+    import rasterio
+    from rasterio.windows import Window, from_bounds
+except ImportError:
+    rasterio = None
+
+# (west, south, east, north) of the study area, same rectangle as the arcpy clip
+clip_bbox = (-76.232, 36.735, -75.941, 36.937)
+mm_per_inch = 25.4
+
+
+def check_rasterio():
+    if rasterio is None:
+        raise ImportError('rasterio is needed to read the NEXRAD rasters')
+
+
+def closest_to_hour(f_names):
+    """
+    :param f_names: raster names ending in _HHMMSS.tif
+    :return: name of the file closest to every whole hour of the day (the first one on a tie), like
+    the loop in reclass_rsters.py
+    """
+    f_hours = np.array([f.replace('.tif', '').split('_')[-1] for f in f_names]).astype(int)
+    check_hours = np.arange(0, 240000, step=10000)
+    idx = np.abs(f_hours[np.newaxis, :] - check_hours[:, np.newaxis]).argmin(axis=1)
+    return [f_names[i] for i in idx]
+
+
+def bbox_window(src, bbox):
+    # window of the cells touching the box, limited to the raster
+    window = from_bounds(*bbox, transform=src.transform)
+    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+    return window.intersection(Window(0, 0, src.width, src.height))
+
+
+def read_window(src, window, out):
+    # read band 1 of a window into out (float32) with NoData as NaN
+    src.read(1, window=window, out=out)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        out[out == src.nodata] = np.nan
+    return out
+
+
+def write_raster(path, arr, profile):
+    profile = dict(profile, driver='GTiff', count=1, dtype='float32', nodata=np.nan)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr, 1)
+
+
+def accumulate(paths, bbox=clip_bbox, reclass_dir=None):
+    """
+    sum of the clipped rasters with negatives set to 0. rasters without any data in the box are
+    skipped; NoData cells of the others stay NoData in the sum (like adding arcpy rasters)
+    :param paths: rasters to add (the same grid)
+    :param bbox: (west, south, east, north) box to clip to before anything else
+    :param reclass_dir: optional directory to also write every clipped, reclassed raster to
+    :return: float32 sum in the units of the rasters (or None if nothing was added) and the
+    rasterio profile of the clipped grid
+    """
+    check_rasterio()
+    acc = None
+    scan = None
+    profile = None
+    for path in paths:
+        with rasterio.open(path) as src:
+            window = bbox_window(src, bbox)
+            shape = (int(window.height), int(window.width))
+            if scan is None:
+                scan = np.empty(shape, dtype=np.float32)
+                profile = dict(src.profile, height=shape[0], width=shape[1],
+                               transform=src.window_transform(window))
+            elif scan.shape != shape:
+                raise ValueError('{} is not on the grid of the first raster'.format(path))
+            read_window(src, window, scan)
+        if not np.isfinite(scan).any():
+            print "{} file seems to be all null".format(os.path.basename(path))
+            continue
+        print "calculating for {}".format(os.path.basename(path))
+        np.maximum(scan, 0, out=scan)
+        if acc is None:
+            acc = scan.copy()
+        else:
+            acc += scan
+        if reclass_dir:
+            write_raster(os.path.join(reclass_dir, 'rcls_{}'.format(os.path.basename(path))),
+                         scan, profile)
+    return acc, profile
+
+
+def storm_total(rain_date, nexrad_dir=None, bbox=clip_bbox, write_reclass=False):
+    """
+    storm total (mm) of a day from the scans closest to every hour, written to
+    <nexrad dir>/<date>/sum/sum_<date>.tif
+    :param rain_date: day as 'YYYYMMDD'
+    :param nexrad_dir: directory with one directory of rasters (inches) per day
+    :param write_reclass: also write the reclassed hourly rasters to the 'reclass' directory
+    :return: the storm total array
+    """
+    day_dir = os.path.join(nexrad_dir or os.path.join(data_dir, 'nexrad'), rain_date)
+    filenames = sorted(f for f in os.listdir(day_dir) if f.endswith('.tif'))
+    hours = closest_to_hour(filenames)
+    reclass_dir = None
+    if write_reclass:
+        reclass_dir = os.path.join(day_dir, 'reclass')
+        check_dir(reclass_dir)
+    total, profile = accumulate([os.path.join(day_dir, f) for f in hours], bbox, reclass_dir)
+    if total is None:
+        print "no data for {}".format(rain_date)
+        return None
+    total *= mm_per_inch
+    sum_dir = os.path.join(day_dir, 'sum')
+    check_dir(sum_dir)
+    write_raster(os.path.join(sum_dir, 'sum_{}.tif'.format(rain_date)), total, profile)
+    return total
+
+
+if __name__ == '__main__':
+    storm_total("20151002")
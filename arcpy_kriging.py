@@ -4,8 +4,13 @@ import string
 import itertools
 import arcpy
 from arcpy import env
+import numpy as np
 import pandas as pd
 from storm_stats_functions import check_dir, get_data_frame_from_table, data_dir
+from kriging import gauge_points
+from model_params import get_param_registry
+from gauge_network import GaugeNetwork
+from nexrad.nexrad_index import get_nexrad_index
 import shutil
 import os
 import psutil
@@ -13,32 +18,12 @@ import stat
 import datetime
 
 
-class ModelParams():
-    def __init__(self, tpe, d):
-        if tpe == 'fifteen_min':
-            tpe = 'fif'
-        table = "{}_model_params".format(tpe)
-        param_df = get_data_frame_from_table(table)
-        param_df.set_index('date', inplace=True)
-
-        self.model_type = param_df['type'][d]
-        self.lag_size = "1000.000000"
-        self.range = param_df['range'][d]
-        self.sill = param_df['sill'][d]
-        self.nugget = "0"  # todo get this from R script
-        self.sample_num = "27"  # todo make this dynamic?
-        self.krad = arcpy.sa.RadiusVariable(27, 20000)
-        self.sample_type = "Variable"
-
-
-def take_out_gages(df, x, y, k):
-    df['dist'] = ((df['x'] - x) ** 2 + (df['y'] - y) ** 2) ** 0.5
-    df = df.sort_values('dist')
-    df = df.reset_index()
-    dists = [df.ix[i, 'dist'] for i in range(k)]
-    stations_removed = [df.ix[i, 'site_name'] for i in range(k)]
-    df = df.ix[k:]
-    return df, dists, stations_removed
+def take_out_gages(df, network, x, y, k):
+    # remove the k gauges nearest to (x, y); network is the GaugeNetwork of df's rows
+    dists, ids = network.nearest((x, y), k)
+    stations_removed = network.site_names[ids].tolist()
+    df = df.iloc[np.setdiff1d(network.site_ids, ids)]
+    return df, dists.tolist(), stations_removed
 
 
 def change_permissions_recursive(path):
@@ -144,30 +129,21 @@ def make_iterator_list(wshed_ids, dates, exp_num=1):
     return overall_iterator_list
 
 
-def make_date_shapefile(date, df):
-    # convert to excel then to table then to layer then to shapefile... phew!
-    date_df = df[['site_name', 'x', 'y', 'src', date]]  # get df for individual timestep
-    date_df = date_df[date_df[date].notnull()]
-    date_df.columns = ['site_name', 'x', 'y', 'src', 'z']
-    global k_dir
+def make_date_points(date, df, debug_shp=False):
+    # hand the gauges of a time step to arcpy as an in-memory feature class
+    xy, z, site_names = gauge_points(df, date)
+    pts = np.zeros(len(z), dtype=[('x', 'f8'), ('y', 'f8'), ('z', 'f8')])
+    pts['x'] = xy[:, 0]
+    pts['y'] = xy[:, 1]
+    pts['z'] = z
+    spref = arcpy.SpatialReference("NAD 1983 HARN StatePlane Virginia South FIPS 4502 (Meters)")
     rand_str = "".join(random.choice(string.lowercase) for i in range(4))
-    date_table = "date_csv{}.csv".format(rand_str)
-    date_df.to_csv(date_table, index=False)
-    tbl = "tab_{}.dbf".format(rand_str)
-
-    arcpy.TableToTable_conversion(date_table, k_dir, tbl)
-
-    spref = r"Coordinate Systems/Projected Coordinate Systems/State Plane/Nad 1983/" \
-            r"NAD 1983 HARN StatePlane Virginia South FIPS 4502 (Meters).prj"
-    lyr = "Layer_{}".format(rand_str)
-    arcpy.MakeXYEventLayer_management(tbl, 'x', 'y', lyr, spref)
-
-    shp = 'temp_{}.shp'.format(rand_str)
-    arcpy.CopyFeatures_management(lyr, shp)
-    arcpy.Delete_management(date_table)
-    arcpy.Delete_management(lyr)
-    arcpy.Delete_management(tbl)
-    return shp
+    fc = "in_memory/pts_{}".format(rand_str)
+    arcpy.da.NumPyArrayToFeatureClass(pts, fc, ('x', 'y'), spref)
+    if debug_shp:
+        # keep a shapefile of the points for debugging
+        arcpy.CopyFeatures_management(fc, 'temp_{}.shp'.format(rand_str))
+    return fc
 
 
 def filter_dates(all_dates, filt_dates):
@@ -180,17 +156,9 @@ def filter_dates(all_dates, filt_dates):
 
 
 def get_nexrad_file(ts):
-    ts_utc = ts + datetime.timedelta(hours=5)
-    d = os.path.join(data_dir, "nexrad/{}".format(ts.strftime('%Y%m%d')))
-    files = os.listdir(d)
-    nexrad_time_strings = [t.split("_")[-2] + t.split("_")[-1] for t in files]
-    nexrad_time_strings_cln = [t.split(".")[0] for t in nexrad_time_strings]
-    nexrad_times = [datetime.datetime.strptime(t, "%Y%m%d%H%M%S") for t in nexrad_time_strings_cln]
-    for i in range(len(nexrad_times)):
-        if ts_utc - datetime.timedelta(minutes=10) < nexrad_times[i] < ts_utc + datetime.timedelta(minutes=10):
-            return os.path.join(d, files[i])
-
-
+    # scan within 10 minutes of a local time step
+    index = get_nexrad_index(os.path.join(data_dir, "nexrad"))
+    return index.nearest_local(ts, max_diff=datetime.timedelta(minutes=10))
 
 
 # specify type; should be 'fifteen_min', 'hr', or 'daily'
@@ -203,11 +171,16 @@ non_zero_dates = a.columns[a.sum() > 0]
 filt_dates = ['2014-09-13', '2015-04-14', '2015-09-30', '2015-10-02']
 non_zero_dates = filter_dates(non_zero_dates, filt_dates)
 wshed_df = get_data_frame_from_table('wshed_ids')
+params = get_param_registry(tpe)
+network = GaugeNetwork.from_frame(df)
 
 # set up arcpy environment
 arcpy.CheckOutExtension("spatial")
 env.extent = arcpy.Extent(3705690, 1051630, 3724920, 1068584)
-k_dir = 'C:/Users/Jeff/Google Drive/Hampton Roads GIS Data/VA_Beach_Data/kriging'
+# every process gets its own workspace, so the fixed names of the intermediate data (selection.shp,
+# rainEst, var, out_tab) do not collide when several copies of the script run at once
+k_dir = os.path.join('C:/Users/Jeff/Google Drive/Hampton Roads GIS Data/VA_Beach_Data/kriging',
+                     'pid_{}'.format(os.getpid()))
 check_dir(k_dir)
 change_permissions_recursive(k_dir)
 os.chmod(k_dir, stat.S_IWRITE)
@@ -230,13 +203,13 @@ res_df = pd.DataFrame(columns=['watershed_descr',
 
 # do it these watersheds (according to arcid)
 iterator_list = make_iterator_list(wshed_ids=[0], dates=non_zero_dates)
-for i in iterator_list:
-    counter = iterator_list.index(i)
+max_tries = 5
+for counter, i in enumerate(iterator_list):
 
     wshed_id = i[0]
     num_removed = i[1]
     date = i[2]
-    while True:
+    for attempt in range(max_tries):
         # select individual watershed
         try:
             sel = "selection.shp"
@@ -249,7 +222,7 @@ for i in iterator_list:
 
             # do it for all the different number of removed stations
             if num_removed > 0:
-                res = take_out_gages(df, wshed_x, wshed_y, num_removed)
+                res = take_out_gages(df, network, wshed_x, wshed_y, num_removed)
                 red_df = res[0]
                 dists_removed = res[1]
                 stations_removed = res[2]
@@ -261,10 +234,10 @@ for i in iterator_list:
                 # timestamp = datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
 
             check_dir(k_dir)
-            rain_shp = make_date_shapefile(date, red_df)
+            rain_shp = make_date_points(date, red_df)
 
             #  get model params
-            mp = ModelParams(tpe, date)
+            mp = params[date]
 
             # do kriging
             out_est_file = "rainEst"
@@ -314,8 +287,11 @@ for i in iterator_list:
             )
             arcpy.Delete_management(sel)
         except UnboundLocalError:
-            print "we have a problem"
+            # the zonal statistics table came back empty (e.g. a lock on the workspace); try again
+            print "we have a problem (attempt {} of {})".format(attempt + 1, max_tries)
             continue
         break
+    else:
+        print "skipping {} {} {} after {} attempts".format(wshed_id, date, num_removed, max_tries)
     # Todo: put in loop for each of the time steps
 # Todo: loop through each station removing one by one and see the effect on the rainfall estimation
@@ -0,0 +1,122 @@
+# Purpose: Geometry of the gauge network (coordinates, ids, sources) with a cached distance
+# matrix and a k-d tree for nearest neighbor and radius queries, shared by the modules that need
+# gauge distances
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from storm_stats_functions import get_data_frame_from_table, get_db_version
+
+# networks by table name, rebuilt when the database changes (see get_gauge_network)
+_networks = {}
+
+
+class GaugeNetwork:
+    def __init__(self, xy, site_names=None, src=None):
+        """
+        :param xy: (n x 2) gauge coordinates (State Plane, m)
+        :param site_names: optional (n,) gauge names (site ids are the positions 0..n-1)
+        :param src: optional (n,) source of every gauge ('hrsd', 'vab', 'wu'...)
+        """
+        self.xy = np.ascontiguousarray(xy, dtype=np.float64)
+        n = len(self.xy)
+        self.site_ids = np.arange(n)
+        if site_names is None:
+            site_names = self.site_ids
+        self.site_names = np.asarray(site_names, dtype=object)
+        src = pd.Categorical(src if src is not None else [''] * n)
+        self.src_categories = np.asarray(src.categories, dtype=object)
+        self.src_codes = np.asarray(src.codes)
+        self._ids = dict((s, i) for i, s in enumerate(self.site_names))
+        self._distances = None
+        self._tree = None
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        :param df: data frame with 'x', 'y' and 'src' columns and the gauge names in a
+        'site_name' column or the index
+        """
+        site_names = df['site_name'].values if 'site_name' in df.columns else df.index.values
+        src = df['src'].values if 'src' in df.columns else None
+        return cls(df[['x', 'y']].values, site_names, src)
+
+    def __len__(self):
+        return len(self.xy)
+
+    @property
+    def src(self):
+        return self.src_categories[self.src_codes]
+
+    @property
+    def distances(self):
+        # (n x n) matrix of the distances between the gauges, computed on first use
+        if self._distances is None:
+            self._distances = cdist(self.xy, self.xy)
+        return self._distances
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.xy)
+        return self._tree
+
+    def ids(self, site_names):
+        return np.array([self._ids[s] for s in site_names], dtype=int)
+
+    def src_mask(self, src):
+        """
+        :param src: source name or list of source names
+        :return: boolean mask of the gauges from those sources
+        """
+        srcs = [src] if isinstance(src, basestring) else list(src)
+        codes = [i for i, c in enumerate(self.src_categories) if c in srcs]
+        return np.in1d(self.src_codes, codes)
+
+    def distances_to(self, point):
+        return np.hypot(self.xy[:, 0] - point[0], self.xy[:, 1] - point[1])
+
+    def nearest(self, point, k):
+        """
+        :param point: (x, y)
+        :param k: number of gauges
+        :return: distances and site ids of the k gauges nearest to the point, nearest first
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros(0), np.zeros(0, dtype=int)
+        dists, ids = self.tree.query(point, k)
+        return np.atleast_1d(dists), np.atleast_1d(ids)
+
+    def within(self, point, r):
+        """
+        :return: distances and site ids of the gauges within r of the point, nearest first
+        """
+        ids = np.array(self.tree.query_ball_point(point, r), dtype=int)
+        dists = self.distances_to(point)[ids]
+        order = np.argsort(dists, kind='mergesort')
+        return dists[order], ids[order]
+
+    def min_distance(self, mask=None):
+        """
+        smallest distance between two gauges at different places (like
+        R/diff_in_gauge_distances.R)
+        :param mask: optional boolean mask of the gauges to consider
+        """
+        d = self.distances if mask is None else self.distances[np.ix_(mask, mask)]
+        return d[d > 0].min()
+
+
+def get_gauge_network(table_name='sites_list'):
+    """
+    the network of the gauges of a table with 'site_name', 'x', 'y' and 'src' columns, built once
+    per process and database version
+    """
+    version = get_db_version()
+    if table_name not in _networks or _networks[table_name][0] != version:
+        df = get_data_frame_from_table(table_name, columns=['site_name', 'x', 'y', 'src'])
+        df['x'] = pd.to_numeric(df['x'])
+        df['y'] = pd.to_numeric(df['y'])
+        _networks[table_name] = (version, GaugeNetwork.from_frame(df))
+    return _networks[table_name][1]
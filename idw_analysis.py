@@ -1,86 +1,160 @@
 from storm_stats_functions import *
+from gauge_network import GaugeNetwork
 
 
-def idw(neigh):
-    neigh['wv'] = neigh.val/neigh.dist
-    pv = neigh.wv.sum()/sum(1/neigh.dist)
-    return pv
+def neighbor_lists(dist, stations, cand, k=3, max_dist=5000.):
+    """
+    neighbors of the stations among the candidate gauges of one availability pattern: the
+    gauges within max_dist after the closest one (the station itself), or the k after it if
+    there are fewer than k of those
+    :param dist: (site x site) distance matrix
+    :param stations: positions of the stations
+    :param cand: positions of the candidate gauges
+    :return: (station x max neighbors) arrays of neighbor positions, distances and a mask of the
+    real entries, and the number of neighbors within max_dist of every station
+    """
+    d = dist[np.ix_(stations, cand)]
+    order = np.argsort(d, axis=1, kind='mergesort')
+    d_sorted = np.take_along_axis(d, order, axis=1)
+    num_neighs = np.maximum((d_sorted < max_dist).sum(axis=1) - 1, 0)
+    end = np.where(num_neighs < k, np.minimum(1 + k, len(cand)), num_neighs + 1)
+    width = max(end.max() - 1, 0)
+    mask = np.arange(1, 1 + width) < end[:, np.newaxis]
+    return cand[order[:, 1:1 + width]], d_sorted[:, 1:1 + width], mask, num_neighs
+
+
+def idw(vals, neigh_d, mask):
+    """
+    inverse distance prediction and standard deviation (ddof 1) of the neighbor values
+    :param vals: (station x neighbor x time) neighbor values
+    :param neigh_d: (station x neighbor) neighbor distances
+    :param mask: (station x neighbor) mask of the real neighbors
+    :return: (station x time) predictions and standard deviations
+    """
+    m = mask[:, :, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        inv_d = np.where(mask, 1. / neigh_d, 0.)[:, :, np.newaxis]
+        vals = np.where(m, vals, 0.)
+        pred = (vals * inv_d).sum(axis=1) / inv_d.sum(axis=1)
+        n = m.sum(axis=1)
+        dev = np.where(m, vals - (vals.sum(axis=1) / n)[:, np.newaxis], 0.)
+        std = np.sqrt((dev ** 2).sum(axis=1) / (n - 1))
+    return pred, std
 
 
 def analyze_from_neighbors(df, outlier_check):
-    indiv_df = pd.DataFrame()
-    summary_df = pd.DataFrame()
-    stations = df.index
-    for station in stations:
-        print "---- {} -----".format(station)
-        count = 0
-        for d in df.columns[3:]:
-            if not math.isnan(df.loc[station][d]):
-                count += 1
-                filt_df = df[df[d].notnull()]
-                if outlier_check:
-                    filt_df = filt_df[filt_df['src'] != 'wu']
-                samp_x = df.loc[station]['x']
-                samp_y = df.loc[station]['y']
-
-                dists = ((samp_x-filt_df['x'])**2 + (samp_y-filt_df['y'])**2)**0.5
-                k = 3
-                dists.sort_values(inplace=True)
-                closest_points = dists[dists < 5000]
-                closest_points = closest_points[1:]
-                num_neighs = closest_points.shape[0]
-                if num_neighs < k:
-                    closest_points = dists[1:1+k]
-                closest_neigh_dist = closest_points[0]
-                furthest_neigh_dist = closest_points[-1]
-                ave_distance = closest_points.mean()
-
-                neigh = filt_df.loc[closest_points.index][d]
-                dists = pd.concat([closest_points, neigh], axis=1, keys=['dist', 'val'])
-                pred_val = idw(dists)
-                neigh_std = neigh.std()
-                samp_prcp = df.loc[station][d]
-                neigh_diff = abs(pred_val - samp_prcp)
-                if outlier_check:
-                    percent_diff = neigh_diff*2/(samp_prcp+pred_val)
-                else:
-                    percent_diff = neigh_diff/samp_prcp
-                out = 'NA'
-                if neigh_diff > neigh_std*3:
-                    out = 'a'
-                if samp_prcp == 0 and pred_val > 10:
-                    out = 'b'
-                indiv_df = indiv_df.append({'datetime': d,
-                                            'true_station': station,
-                                            'recorded_val': samp_prcp,
-                                            'neighbors': closest_points.index.tolist(),
-                                            'num_neighbors': num_neighs,
-                                            'shortest_dist': closest_neigh_dist,
-                                            'longest_dist': furthest_neigh_dist,
-                                            'ave_distance': ave_distance,
-                                            'pred_val': pred_val,
-                                            'global_mean': filt_df[d].mean(),
-                                            'percent_diff': percent_diff,
-                                            'index': percent_diff/ave_distance,
-                                            'src': df.loc[station]['src'],
-                                            'out': out
-                                            },
-                                           ignore_index=True)
-        s_df = indiv_df[indiv_df['true_station'] == station]
+    """
+    compare every value with the inverse distance prediction from its neighbors. the neighbors
+    only depend on which gauges reported, so they are found once per availability pattern and
+    applied to all the time steps with that pattern at once
+    :param df: wide table indexed by site_name with 'x', 'y', 'src' and one column per time step
+    :param outlier_check: leave the 'wu' gauges out of the neighbors, flag outliers ('a': further
+    than 3 neighbor standard deviations from the prediction, 'b': 0 recorded where more than 10
+    is predicted) and only return the flagged values
+    :return: data frame of the compared values and data frame of the per station summaries
+    """
+    stations = df.index.values
+    dates = df.columns[3:]
+    values = df[dates].values.astype(float)
+    dist = GaugeNetwork.from_frame(df).distances
+    avail = np.isfinite(values)
+    use = avail & (df['src'].values != 'wu')[:, np.newaxis] if outlier_check else avail
+
+    patterns = {}
+    for j in range(len(dates)):
+        patterns.setdefault(avail[:, j].tobytes(), []).append(j)
+
+    parts = []
+    for cols in patterns.values():
+        cols = np.array(cols)
+        sta = np.flatnonzero(avail[:, cols[0]])
+        cand = np.flatnonzero(use[:, cols[0]])
+        if len(sta) == 0 or len(cand) == 0:
+            continue
+        neigh, neigh_d, mask, num_neighs = neighbor_lists(dist, sta, cand)
+        v = values[:, cols]
+        pred, std = idw(v[neigh], neigh_d, mask)
+
+        # first, last and mean neighbor distance of every station (NaN without neighbors)
+        n_d = mask.sum(axis=1)
+        padded = np.column_stack([neigh_d, np.full(len(sta), np.nan)])
+        rows = np.arange(len(sta))
+        shortest = padded[rows, np.where(n_d > 0, 0, neigh_d.shape[1])]
+        longest = padded[rows, np.where(n_d > 0, n_d - 1, neigh_d.shape[1])]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ave_distance = np.where(mask, neigh_d, 0.).sum(axis=1) / n_d
+        neighbors = [stations[neigh[r][mask[r]]].tolist() for r in rows]
+
+        n_t = len(cols)
+        parts.append(pd.DataFrame({'sta': np.repeat(sta, n_t),
+                                   'col': np.tile(cols, len(sta)),
+                                   'recorded_val': v[sta].ravel(),
+                                   'pred_val': pred.ravel(),
+                                   'neigh_std': std.ravel(),
+                                   'global_mean': np.tile(v[cand].mean(axis=0), len(sta)),
+                                   'num_neighbors': np.repeat(num_neighs, n_t),
+                                   'shortest_dist': np.repeat(shortest, n_t),
+                                   'longest_dist': np.repeat(longest, n_t),
+                                   'ave_distance': np.repeat(ave_distance, n_t),
+                                   'neighbors': [l for l in neighbors for c in cols]}))
+
+    if parts:
+        res = pd.concat(parts, ignore_index=True)
+    else:
+        res = pd.DataFrame(columns=['sta', 'col', 'recorded_val', 'pred_val', 'neigh_std',
+                                    'global_mean', 'num_neighbors', 'shortest_dist',
+                                    'longest_dist', 'ave_distance', 'neighbors'])
+    # same order as looping over the stations and then the time steps
+    res = res.sort_values(['sta', 'col'], kind='mergesort').reset_index(drop=True)
+    samp_prcp = res['recorded_val'].values.astype(float)
+    pred_val = res['pred_val'].values.astype(float)
+    neigh_diff = abs(pred_val - samp_prcp)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if outlier_check:
+            percent_diff = neigh_diff * 2 / (samp_prcp + pred_val)
+        else:
+            percent_diff = neigh_diff / samp_prcp
+        out = np.where(neigh_diff > res['neigh_std'].values.astype(float) * 3, 'a', 'NA')
+        out = np.where((samp_prcp == 0) & (pred_val > 10), 'b', out)
+        index = percent_diff / res['ave_distance'].values.astype(float)
+    sta = res['sta'].values.astype(int)
+    indiv_df = pd.DataFrame({'datetime': dates.values[res['col'].values.astype(int)],
+                             'true_station': stations[sta],
+                             'recorded_val': samp_prcp,
+                             'neighbors': res['neighbors'].values,
+                             'num_neighbors': res['num_neighbors'].values,
+                             'shortest_dist': res['shortest_dist'].values,
+                             'longest_dist': res['longest_dist'].values,
+                             'ave_distance': res['ave_distance'].values,
+                             'pred_val': pred_val,
+                             'global_mean': res['global_mean'].values,
+                             'percent_diff': percent_diff,
+                             'index': index,
+                             'src': df['src'].values[sta],
+                             'out': out})
+
+    summaries = []
+    bounds = np.searchsorted(sta, np.arange(len(stations) + 1))
+    for i, station in enumerate(stations):
+        s_df = indiv_df.iloc[bounds[i]:bounds[i + 1]]
         if outlier_check:
             n_out = sum(s_df.out != 'NA')
             n_poss = float(s_df.shape[0])
             if not n_poss:
                 continue
+            # neighbors of the station's last time step
+            last = s_df.iloc[-1]
             indivi_summ = {'n_out': n_out, 'n_poss': n_poss, 'percent_out': (n_out/n_poss),
-                           'neighbors': closest_points.index.tolist(), 'num_neighbors': num_neighs,
-                           'shortest_dist': closest_neigh_dist, 'longest_dist': furthest_neigh_dist,
-                           'ave_distance': ave_distance}
+                           'neighbors': last['neighbors'], 'num_neighbors': last['num_neighbors'],
+                           'shortest_dist': last['shortest_dist'],
+                           'longest_dist': last['longest_dist'],
+                           'ave_distance': last['ave_distance']}
         else:
             indivi_summ = error_summary(s_df)
         indivi_summ['station'] = station
-        indivi_summ['src'] = df.loc[station]['src']
-        summary_df = summary_df.append(indivi_summ, ignore_index=True)
+        indivi_summ['src'] = df['src'].values[i]
+        summaries.append(indivi_summ)
+    summary_df = pd.DataFrame(summaries)
     if outlier_check:
         indiv_df = indiv_df[indiv_df['out'] != 'NA']
     return indiv_df, summary_df
@@ -98,11 +172,13 @@ def error_summary(error_df):
                'max mm diff': maxdif}
     return summary
 
-fmin = read_sub_daily('fif')
-c = analyze_from_neighbors(fmin, True)
-for df in c:
-    l = [str(df['neighbors'][i]) for i in df.index]
-    df['neighbors'] = l
-update_table('qc_results', c[0])
-update_table('qc_summary', c[1])
+
+if __name__ == '__main__':
+    fmin = read_sub_daily('fif')
+    c = analyze_from_neighbors(fmin, True)
+    for df in c:
+        l = [str(df['neighbors'][i]) for i in df.index]
+        df['neighbors'] = l
+    update_table('qc_results', c[0])
+    update_table('qc_summary', c[1])
 
@@ -0,0 +1,393 @@
+# Purpose: Ordinary kriging of the gauge data onto the study grid with numpy/scipy, as a
+# replacement for arcpy.gp.Kriging_sa that runs on any platform
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import lu_factor, lu_solve
+from scipy.spatial.distance import cdist
+from storm_stats_functions import get_data_frame_from_table
+from model_params import get_param_registry
+from gauge_network import GaugeNetwork
+
+# same extent and cell size as the arcpy scripts (env.extent and cell_size)
+study_extent = (3705690, 1051630, 3724920, 1068584)
+study_cell_size = 61.3231323600002
+
+
+class Grid:
+    def __init__(self, extent=study_extent, cell_size=study_cell_size):
+        """
+        raster grid with rows running north to south, like the arcpy output rasters
+        :param extent: (xmin, ymin, xmax, ymax) in the State Plane coordinates of the gauges (m)
+        :param cell_size: cell size (m)
+        """
+        self.xmin, self.ymin, self.xmax, self.ymax = [float(e) for e in extent]
+        self.cell_size = float(cell_size)
+        self.ncols = int(np.ceil((self.xmax - self.xmin) / self.cell_size))
+        self.nrows = int(np.ceil((self.ymax - self.ymin) / self.cell_size))
+
+    @property
+    def shape(self):
+        return self.nrows, self.ncols
+
+    @property
+    def size(self):
+        return self.nrows * self.ncols
+
+    def key(self):
+        return self.xmin, self.ymin, self.xmax, self.ymax, self.cell_size
+
+    def cell_x(self):
+        return self.xmin + (np.arange(self.ncols) + 0.5) * self.cell_size
+
+    def cell_y(self):
+        return self.ymax - (np.arange(self.nrows) + 0.5) * self.cell_size
+
+    def cell_centers(self):
+        # (size x 2) array of cell center coordinates in row-major order
+        xx, yy = np.meshgrid(self.cell_x(), self.cell_y())
+        return np.column_stack([xx.ravel(), yy.ravel()])
+
+
+def semivariance(h, model_type, rng, sill, nugget=0.):
+    """
+    semivariogram with the ArcGIS conventions (practical range, partial sill)
+    :param h: array of distances
+    :param model_type: 'Spherical', 'Exponential', 'Gaussian' or 'Circular'
+    :param rng: range
+    :param sill: partial sill
+    :param nugget: nugget
+    :return: array of semivariances, 0 where h is 0
+    """
+    h = np.asarray(h, dtype=float)
+    hr = h / float(rng)
+    model = model_type.lower()
+    if model.startswith('sph'):
+        g = np.where(hr < 1, 1.5 * hr - 0.5 * hr ** 3, 1.)
+    elif model.startswith('exp'):
+        g = 1. - np.exp(-3. * hr)
+    elif model.startswith('gau'):
+        g = 1. - np.exp(-3. * hr ** 2)
+    elif model.startswith('cir'):
+        hc = np.minimum(hr, 1.)
+        g = np.where(hr < 1, 1. - 2. / np.pi * np.arccos(hc) +
+                     2. / np.pi * hc * np.sqrt(1. - hc ** 2), 1.)
+    else:
+        raise ValueError('unknown variogram model: {}'.format(model_type))
+    gamma = nugget + sill * g
+    gamma[h == 0] = 0.
+    return gamma
+
+
+class OrdinaryKriging:
+    def __init__(self, xy, model_type, rng, sill, nugget=0., dist=None):
+        """
+        ordinary kriging system of one gauge configuration and variogram. the system is factorized
+        once and reused for any number of target points and time steps
+        :param xy: (n x 2) array of gauge coordinates
+        :param dist: optional (n x n) distances between the gauges (e.g. from a GaugeNetwork)
+        """
+        self.xy = np.ascontiguousarray(xy, dtype=float)
+        self.model = (model_type, float(rng), float(sill), float(nugget))
+        n = len(self.xy)
+        a = np.ones((n + 1, n + 1))
+        a[n, n] = 0.
+        a[:n, :n] = self.gamma(cdist(self.xy, self.xy) if dist is None else dist)
+        self.a = a
+        self.lu = lu_factor(a)
+
+    @property
+    def n(self):
+        return len(self.xy)
+
+    def gamma(self, h):
+        return semivariance(h, *self.model)
+
+    def rhs(self, targets):
+        b = np.ones((self.n + 1, len(targets)))
+        b[:self.n] = self.gamma(cdist(self.xy, targets))
+        return b
+
+    def weights(self, targets):
+        """
+        :param targets: (m x 2) array of points to estimate
+        :return: (n x m) kriging weights and (m,) kriging variances
+        """
+        b = self.rhs(targets)
+        x = lu_solve(self.lu, b)
+        lam = x[:self.n]
+        var = (lam * b[:self.n]).sum(axis=0) + x[self.n]
+        return lam, var
+
+    def predict(self, targets, values, chunk_size=20000):
+        """
+        :param targets: (m x 2) array of points to estimate
+        :param values: (n,) gauge values or (n x t) values of t time steps
+        :return: estimates ((m,) or (m x t)) and (m,) kriging variances
+        """
+        values = np.asarray(values, dtype=float)
+        est = np.empty((len(targets),) + values.shape[1:])
+        var = np.empty(len(targets))
+        for s in range(0, len(targets), chunk_size):
+            lam, var[s:s + chunk_size] = self.weights(targets[s:s + chunk_size])
+            est[s:s + chunk_size] = np.dot(lam.T, values)
+        return est, var
+
+
+def block_rhs(ok, block_points, block_weights=None):
+    """
+    average semivariances of a block (e.g. a watershed) discretized by points
+    :param ok: OrdinaryKriging system of the gauges
+    :param block_points: (m x 2) points discretizing the block
+    :param block_weights: optional (m,) weights of the points (uniform by default)
+    :return: (n + 1,) right-hand side (gauge-to-block semivariances and 1) and the block-to-block
+    semivariance
+    """
+    if block_weights is None:
+        block_weights = np.ones(len(block_points))
+    w = np.asarray(block_weights, dtype=float) / np.sum(block_weights)
+    b = np.dot(ok.rhs(block_points), w)
+    gamma_bb = np.dot(w, np.dot(ok.gamma(cdist(block_points, block_points)), w))
+    return b, gamma_bb
+
+
+def block_kriging_weights(ok, block_points, block_weights=None):
+    """
+    block (watershed average) kriging weights and variance of a gauge configuration
+    :return: (n,) weights and the block kriging variance
+    """
+    b, gamma_bb = block_rhs(ok, block_points, block_weights)
+    x = lu_solve(ok.lu, b)
+    lam = x[:ok.n]
+    return lam, np.dot(lam, b[:ok.n]) + x[ok.n] - gamma_bb
+
+
+def block_krige_time_steps(xy, values, dates, param_df, block_points, block_weights=None,
+                           watershed_descr=""):
+    """
+    block kriging of the watershed average rainfall of many time steps without a grid. the
+    weights and block variance are computed once per group of time steps (see group_time_steps);
+    each estimate is then a dot product with the gauge values
+    :param xy: (n x 2) gauge coordinates
+    :param values: (n x t) gauge values, NaN where a gauge did not report
+    :param dates: (t,) time stamps of the value columns
+    :param param_df: variogram parameters of the t time steps (see read_model_params)
+    :param block_points: (m x 2) points discretizing the watershed (see
+    zonal_stats.polygon_targets)
+    :param block_weights: optional (m,) weights of the points
+    :return: data frame with 'watershed_descr', 'time_stamp', 'est' and 'var' columns. 'var' is
+    the variance of the watershed average, which is smaller than the watershed mean of the point
+    kriging variances that the arcpy rasters give
+    """
+    network = GaugeNetwork(xy)
+    values = np.asarray(values, dtype=float)
+    sills = param_df['sill'].values.astype(float)
+    records = []
+    for mask, (model_type, rng, nugget_ratio), cols in group_time_steps(values, param_df):
+        ok = OrdinaryKriging(network.xy[mask], model_type, rng, 1., nugget_ratio,
+                             network.distances[np.ix_(mask, mask)])
+        lam, unit_var = block_kriging_weights(ok, block_points, block_weights)
+        est = np.dot(lam, values[mask][:, cols])
+        for i, j in enumerate(cols):
+            records.append({'watershed_descr': watershed_descr,
+                            'time_stamp': dates[j],
+                            'est': est[i],
+                            'var': unit_var * max(sills[j], 0.)})
+    res_df = pd.DataFrame(records, columns=['watershed_descr', 'time_stamp', 'est', 'var'])
+    return res_df.sort_values('time_stamp').reset_index(drop=True)
+
+
+def gauge_points(df, date):
+    """
+    the gauges that reported at a time step as arrays, for the interpolation backends
+    :param df: wide table with 'site_name', 'x', 'y' and one column per time step
+    :param date: time step column
+    :return: (n x 2) coordinates, (n,) values and (n,) site names of the non-null gauges
+    """
+    z = df[date].values.astype(float)
+    mask = np.isfinite(z)
+    xy = df[['x', 'y']].values.astype(float)[mask]
+    return xy, z[mask], df['site_name'].values[mask]
+
+
+def krige_date(df, date, mp, grid=None):
+    """
+    krige one time step straight from the wide table, without writing the gauges to disk
+    :param mp: variogram parameters with 'model_type', 'range', 'sill' and 'nugget' attributes
+    (like ModelParams)
+    :return: estimate and variance grids
+    """
+    grid = grid or Grid()
+    xy, z, site_names = gauge_points(df, date)
+    ok = OrdinaryKriging(xy, mp.model_type, mp.range, mp.sill, float(mp.nugget))
+    est, var = ok.predict(grid.cell_centers(), z)
+    return est.reshape(grid.shape), var.reshape(grid.shape)
+
+
+def read_model_params(tpe):
+    """
+    :param tpe: 'fif' (or 'fifteen_min'), 'hr', 'daily' or one of their '_zeroes' variants
+    :return: data frame of the variogram parameters indexed by date with 'type', 'range', 'sill'
+    and 'nugget' columns
+    """
+    return get_param_registry(tpe).to_frame()
+
+
+def group_time_steps(values, param_df):
+    """
+    group the time steps that share a kriging system: the same gauges reporting and the same
+    variogram up to the sill (the weights do not depend on the sill, the variance scales with it)
+    :param values: (n_gauges x t) array with NaN for missing gauges
+    :param param_df: variogram parameters of the t time steps (see read_model_params)
+    :return: list of (gauge mask, (model_type, range, nugget/sill), column indices)
+    """
+    groups = {}
+    masks = {}
+    sills = param_df['sill'].values.astype(float)
+    scale = np.where(sills > 0, sills, 1.)
+    for j in range(values.shape[1]):
+        mask = np.isfinite(values[:, j])
+        key = (mask.tobytes(), param_df['type'].values[j], float(param_df['range'].values[j]),
+               float(param_df['nugget'].values[j]) / scale[j])
+        groups.setdefault(key, []).append(j)
+        masks[key] = mask
+    return [(masks[k], k[1:], np.array(cols)) for k, cols in groups.items()]
+
+
+def krige_time_steps(xy, values, param_df, grid=None, batch_size=64):
+    """
+    krige many time steps onto a grid. one factorization and one multi-right-hand-side solve is
+    done per group of time steps (see group_time_steps); the estimates of a group are then a
+    matrix product of the weights with the gauge values
+    :param xy: (n_gauges x 2) gauge coordinates
+    :param values: (n_gauges x t) gauge values, NaN where a gauge did not report
+    :param param_df: variogram parameters of the t time steps (see read_model_params)
+    :param grid: Grid to estimate on (the study grid by default)
+    :param batch_size: number of time steps estimated per matrix product
+    :return: generator of (column index, estimate grid, variance grid) in group order
+    """
+    grid = grid or Grid()
+    targets = grid.cell_centers()
+    network = GaugeNetwork(xy)
+    values = np.asarray(values, dtype=float)
+    sills = param_df['sill'].values.astype(float)
+    for mask, (model_type, rng, nugget_ratio), cols in group_time_steps(values, param_df):
+        ok = OrdinaryKriging(network.xy[mask], model_type, rng, 1., nugget_ratio,
+                             network.distances[np.ix_(mask, mask)])
+        lam, unit_var = ok.weights(targets)
+        for s in range(0, len(cols), batch_size):
+            batch = cols[s:s + batch_size]
+            est = np.dot(values[mask][:, batch].T, lam)
+            for i, j in enumerate(batch):
+                var = unit_var * max(sills[j], 0.)
+                yield j, est[i].reshape(grid.shape), var.reshape(grid.shape)
+
+
+def krige_table(tpe, dates=None, grid=None):
+    """
+    krige the time steps of one of the wide tables ('fif', 'hr', 'daily' or their '_zeroes'
+    variants) with the variograms of its '_model_params' table
+    :param dates: time step columns to krige; defaults to the steps that have a variogram
+    :return: generator of (date, estimate grid, variance grid)
+    """
+    df = get_data_frame_from_table(tpe)
+    param_df = read_model_params(tpe)
+    if dates is None:
+        dates = [d for d in param_df.index if d in df.columns]
+    xy = df[['x', 'y']].values.astype(float)
+    values = df[dates].values.astype(float)
+    for j, est, var in krige_time_steps(xy, values, param_df.loc[dates], grid):
+        yield dates[j], est, var
+
+
+def downdate_inverse(a_inv, remove):
+    """
+    inverse of a matrix with some rows and columns deleted, from the inverse of the full matrix
+    (block inverse: B^-1 = P - Q S^-1 Q^T with P, Q, S the kept/kept, kept/removed and
+    removed/removed blocks of the full inverse)
+    :param a_inv: inverse of the full matrix
+    :param remove: indices of the deleted rows and columns
+    :return: inverse of the reduced matrix and the kept indices
+    """
+    keep = np.setdiff1d(np.arange(len(a_inv)), remove)
+    if len(remove) == 0:
+        return a_inv, keep
+    q = a_inv[np.ix_(keep, remove)]
+    s = a_inv[np.ix_(remove, remove)]
+    return a_inv[np.ix_(keep, keep)] - np.dot(q, np.linalg.solve(s, q.T)), keep
+
+
+def leave_nearest_out(xy, site_names, values, dates, param_df, center, targets, num_removed,
+                      watershed_descr="", target_weights=None, block=False):
+    """
+    gauge removal experiment: remove the k gauges nearest to a watershed (like take_out_gages)
+    and record the watershed mean of the kriged estimate and variance for every k. the kriging
+    matrix is inverted once per group of time steps (see group_time_steps) and the reduced
+    networks are downdated from that inverse
+    :param xy: (n x 2) coordinates of all gauges
+    :param site_names: (n,) gauge names
+    :param values: (n x t) gauge values, NaN where a gauge did not report
+    :param dates: (t,) time stamps of the value columns
+    :param param_df: variogram parameters of the t time steps (see read_model_params)
+    :param center: (x, y) of the watershed the removed gauges are nearest to
+    :param targets: (m x 2) points covering the watershed (e.g. the grid cells inside it)
+    :param num_removed: numbers of gauges to remove, e.g. [0, numrem] or range(13)
+    :param watershed_descr: description written to the records
+    :param target_weights: optional (m,) weights of the targets in the mean (uniform by default)
+    :param block: use block kriging of the watershed average over the targets (see
+    block_krige_time_steps) instead of the mean of the point estimates and variances
+    :return: data frame with 'watershed_descr', 'time_stamp', 'num_removed', 'dists',
+    'stations_removed', 'est' and 'var' columns
+    """
+    xy = np.asarray(xy, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if target_weights is None:
+        target_weights = np.ones(len(targets))
+    target_weights = np.asarray(target_weights, dtype=float) / np.sum(target_weights)
+    network = GaugeNetwork(xy)
+    dist = network.distances_to(center)
+    order = np.argsort(dist, kind='mergesort')
+    sills = param_df['sill'].values.astype(float)
+
+    records = []
+    for mask, (model_type, rng, nugget_ratio), cols in group_time_steps(values, param_df):
+        available = np.flatnonzero(mask)
+        ok = OrdinaryKriging(xy[available], model_type, rng, 1., nugget_ratio,
+                             network.distances[np.ix_(available, available)])
+        a_inv = np.linalg.inv(ok.a)
+        if block:
+            # the block right-hand side is the weighted mean of the point ones
+            b, gamma_bb = block_rhs(ok, targets, target_weights)
+            b = b[:, np.newaxis]
+            weights = np.ones(1)
+        else:
+            b = ok.rhs(targets)
+            gamma_bb = 0.
+            weights = target_weights
+        for k in num_removed:
+            removed = order[:k]
+            remove = np.flatnonzero(np.in1d(available, removed))
+            red_inv, keep = downdate_inverse(a_inv, remove)
+            x = np.dot(red_inv, b[keep])
+            n_kept = len(keep) - 1
+            unit_var = np.dot((x[:n_kept] * b[keep][:n_kept]).sum(axis=0) + x[n_kept],
+                              weights) - gamma_bb
+            lam_bar = np.dot(x[:n_kept], weights)
+            est = np.dot(lam_bar, values[available[keep[:n_kept]]][:, cols])
+            if k > 0:
+                dists = dist[removed].tolist()
+                stations_removed = [site_names[i] for i in removed]
+            else:
+                dists = 0
+                stations_removed = ""
+            for i, j in enumerate(cols):
+                records.append({'watershed_descr': watershed_descr,
+                                'time_stamp': dates[j],
+                                'num_removed': k,
+                                'dists': dists,
+                                'stations_removed': stations_removed,
+                                'est': est[i],
+                                'var': unit_var * max(sills[j], 0.)})
+    res_df = pd.DataFrame(records, columns=['watershed_descr', 'time_stamp', 'num_removed',
+                                            'dists', 'stations_removed', 'est', 'var'])
+    return res_df.sort_values(['num_removed', 'time_stamp']).reset_index(drop=True)
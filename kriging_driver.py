@@ -0,0 +1,187 @@
+# Purpose: Parallel, resumable driver of the gauge removal kriging experiment (the main loop of
+# arcpy_kriging.py) on the numpy kriging engine. Work items are (watershed, num_removed,
+# time_stamp); completed items are checkpointed and the results merged deterministically
+
+import os
+import glob
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from storm_stats_functions import get_data_frame_from_table, data_dir, check_dir
+from kriging import read_model_params, leave_nearest_out
+from zonal_stats import get_zonal_weights, polygon_targets
+from gauge_network import GaugeNetwork
+
+result_columns = ['watershed_descr', 'time_stamp', 'num_removed', 'dists', 'stations_removed',
+                  'est', 'var']
+
+# data of a worker process (see init_worker)
+_worker = {}
+
+
+def non_zero_dates(df, filt_dates=None):
+    """
+    :param df: wide table (site_name, x, y, src, one column per time step)
+    :param filt_dates: optional list of days ('YYYY-MM-DD') to keep
+    :return: time steps with rain anywhere in the network
+    """
+    a = df.iloc[:, 4:]
+    dates = a.columns[a.sum() > 0].tolist()
+    if filt_dates is not None:
+        days = set(pd.to_datetime(filt_dates).strftime('%Y-%m-%d'))
+        dates = [d for d in dates if pd.Timestamp(d).strftime('%Y-%m-%d') in days]
+    return dates
+
+
+def make_work_items(wshed_df, wshed_ids, dates, exp_num=1):
+    """
+    same items as make_iterator_list in arcpy_kriging.py
+    :return: list of (watershed id, num_removed, time_stamp)
+    """
+    items = []
+    for i in wshed_ids:
+        if exp_num == 1:
+            num_removed = int(wshed_df[wshed_df.arcid == i]['numrem'].values[0])
+            items.extend(itertools.product([i], [0, num_removed], dates))
+        else:
+            items.extend(itertools.product([i], range(13), dates))
+    return items
+
+
+def item_key(item):
+    return '{}|{}|{}'.format(*item)
+
+
+def make_tasks(items, chunk_size):
+    """
+    shard the items into tasks of one watershed, all of its num_removed values and up to
+    chunk_size time stamps, so a worker can downdate one kriging system for all num_removed
+    :return: list of (watershed id, num_removed list, time_stamp list, item list)
+    """
+    by_wshed = {}
+    for item in items:
+        by_wshed.setdefault(item[0], []).append(item)
+    tasks = []
+    for wshed_id in sorted(by_wshed):
+        by_date = {}
+        for item in by_wshed[wshed_id]:
+            by_date.setdefault(item[2], []).append(item)
+        # time stamps that need the same num_removed values go together
+        by_ks = {}
+        for date in sorted(by_date):
+            ks = tuple(sorted(set(it[1] for it in by_date[date])))
+            by_ks.setdefault(ks, []).append(date)
+        for ks in sorted(by_ks):
+            dates = by_ks[ks]
+            for s in range(0, len(dates), chunk_size):
+                chunk = dates[s:s + chunk_size]
+                task_items = [it for d in chunk for it in by_date[d]]
+                tasks.append((wshed_id, list(ks), chunk, task_items))
+    return tasks
+
+
+def init_worker(tpe, shed_ply, block):
+    # load the inputs once per worker
+    df = get_data_frame_from_table(tpe)
+    _worker['df'] = df
+    _worker['network'] = GaugeNetwork.from_frame(df)
+    _worker['param_df'] = read_model_params(tpe)
+    _worker['wshed_df'] = get_data_frame_from_table('wshed_ids')
+    _worker['weights'] = get_zonal_weights(shed_ply)[0]
+    _worker['block'] = block
+
+
+def run_task(task):
+    wshed_id, num_removed, dates, items = task
+    wshed_df = _worker['wshed_df']
+    i_wshed_df = wshed_df[wshed_df.arcid == wshed_id]
+    wshed_descr = i_wshed_df['Description'].values[0]
+    center = (i_wshed_df['x'].values[0], i_wshed_df['y'].values[0])
+    targets, target_weights = polygon_targets(_worker['weights'], wshed_id)
+    values = _worker['df'][dates].values.astype(float)
+    network = _worker['network']
+    res_df = leave_nearest_out(network.xy, network.site_names, values, dates,
+                               _worker['param_df'].loc[dates], center, targets, num_removed,
+                               wshed_descr, target_weights, _worker['block'])
+    return [item_key(it) for it in items], res_df
+
+
+def read_checkpoint(checkpoint):
+    if not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint) as f:
+        return set(l.strip() for l in f if l.strip())
+
+
+def merge_results(parts_dir, out_dir, tpe):
+    """
+    combine the part files into one csv per watershed, sorted by (num_removed, time_stamp) and
+    with duplicates from re-run tasks dropped
+    """
+    parts = sorted(glob.glob(os.path.join(parts_dir, 'part_*.csv')))
+    if not parts:
+        return pd.DataFrame(columns=result_columns)
+    res_df = pd.concat([pd.read_csv(p) for p in parts], ignore_index=True)
+    res_df = res_df.drop_duplicates(['watershed_descr', 'num_removed', 'time_stamp'], keep='last')
+    res_df = res_df.sort_values(['watershed_descr', 'num_removed', 'time_stamp'])
+    for wshed_descr, w_df in res_df.groupby('watershed_descr'):
+        w_df[result_columns].to_csv(os.path.join(out_dir, '{}_{}.csv'.format(tpe, wshed_descr)),
+                                    index=False)
+    return res_df
+
+
+def run(tpe, shed_ply, wshed_ids, filt_dates=None, exp_num=1, processes=None, chunk_size=50,
+        block=False, out_dir=None):
+    """
+    run the experiment over a process pool. every finished task is written to its own part file
+    and its item keys appended to a checkpoint, so an interrupted run picks up where it stopped
+    :param tpe: wide table to krige, e.g. 'fif_zeroes'
+    :param shed_ply: watershed polygon shapefile (FID = arcid of the 'wshed_ids' table)
+    :param wshed_ids: arcids of the watersheds to do
+    :param filt_dates: optional days to restrict the time steps to
+    :param exp_num: 1 for [0, numrem] gauges removed, 2 for 0 to 12 removed
+    :param processes: size of the pool (number of cpus by default)
+    :param chunk_size: time stamps per task
+    :param block: block kriging of the watershed averages instead of point kriging means
+    :param out_dir: results directory (defaults to 'kriging results/<tpe>' in the data dir)
+    :return: merged results
+    """
+    out_dir = check_dir(out_dir or os.path.join(data_dir, 'kriging results', tpe))
+    parts_dir = check_dir(os.path.join(out_dir, 'parts'))
+    checkpoint = os.path.join(out_dir, 'checkpoint.txt')
+
+    df = get_data_frame_from_table(tpe)
+    param_df = read_model_params(tpe)
+    dates = [d for d in non_zero_dates(df, filt_dates) if d in param_df.index]
+    items = make_work_items(get_data_frame_from_table('wshed_ids'), wshed_ids, dates, exp_num)
+    done = read_checkpoint(checkpoint)
+    items = [it for it in items if item_key(it) not in done]
+    tasks = make_tasks(items, chunk_size)
+    print '{} items done before, {} items in {} tasks to do'.format(len(done), len(items),
+                                                                      len(tasks))
+
+    pool = multiprocessing.Pool(processes, init_worker, (tpe, shed_ply, block))
+    try:
+        n_part = len(glob.glob(os.path.join(parts_dir, 'part_*.csv')))
+        for counter, (keys, res_df) in enumerate(pool.imap_unordered(run_task, tasks)):
+            part = os.path.join(parts_dir, 'part_{:06d}.csv'.format(n_part + counter))
+            res_df.to_csv('{}.tmp'.format(part), index=False)
+            os.rename('{}.tmp'.format(part), part)
+            with open(checkpoint, 'a') as f:
+                f.write(''.join('{}\n'.format(k) for k in keys))
+            print 'task {} of {} done ({} items)'.format(counter + 1, len(tasks), len(keys))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return merge_results(parts_dir, out_dir, tpe)
+
+
+if __name__ == '__main__':
+    run(tpe='fif_zeroes',
+        shed_ply=os.path.join(data_dir, 'GIS/problem_watersheds.shp'),
+        wshed_ids=[0],
+        filt_dates=['2014-09-13', '2015-04-14', '2015-09-30', '2015-10-02'])
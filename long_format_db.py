@@ -0,0 +1,208 @@
+# Purpose: Migrate master.sqlite to an indexed long format (site_id, epoch_seconds, precip_mm, src)
+# and rebuild the wide 'fif', 'hr' and 'daily' tables from it as on-demand pivots. epoch_seconds
+# are UTC, the same time key as the NEXRAD index
+
+import numpy as np
+import pandas as pd
+from storm_stats_functions import get_db_connection, get_data_frame_from_table, \
+    clear_table_cache, update_table
+from nexrad.nexrad_index import local_tz, local_to_epoch
+
+obs_table = 'obs'
+sites_table = 'sites'
+wide_tables = ['fif', 'hr', 'daily']
+
+
+def to_epoch(ts):
+    """
+    :param ts: timestamp(s) as stored in the database (America/New_York wall-clock time, no time
+    zone)
+    :return: int64 seconds since 1970-01-01 UTC, like nexrad_index.local_to_epoch. ambiguous times
+    at the end of daylight saving time are taken as standard time, and so are the (nonexistent)
+    times skipped at its start
+    """
+    ts = pd.to_datetime(ts)
+    if isinstance(ts, pd.Timestamp):
+        return local_to_epoch(ts.to_pydatetime())
+    ts = pd.DatetimeIndex(ts)
+    utc = ts.tz_localize(local_tz.zone, ambiguous=np.zeros(len(ts), dtype=bool),
+                         nonexistent='NaT')
+    epoch = utc.asi8 // 10 ** 9
+    skipped = np.flatnonzero(utc.isna())
+    epoch[skipped] = [local_to_epoch(t) for t in ts[skipped].to_pydatetime()]
+    return epoch
+
+
+def from_epoch(epoch):
+    # UTC seconds back to naive America/New_York wall-clock times
+    utc = pd.to_datetime(np.asarray(epoch, dtype=np.int64), unit='s').tz_localize('UTC')
+    return utc.tz_convert(local_tz.zone).tz_localize(None)
+
+
+def long_table_name(table_name):
+    return '{}_long'.format(table_name)
+
+
+def create_long_schema(con):
+    con.executescript("""
+        DROP TABLE IF EXISTS {sites};
+        CREATE TABLE {sites} (site_id INTEGER PRIMARY KEY,
+                              site_name TEXT UNIQUE NOT NULL,
+                              x REAL,
+                              y REAL,
+                              src TEXT);
+        DROP TABLE IF EXISTS {obs};
+        CREATE TABLE {obs} (site_id INTEGER NOT NULL REFERENCES {sites} (site_id),
+                            epoch_seconds INTEGER NOT NULL,
+                            precip_mm REAL,
+                            src TEXT);
+        DROP TABLE IF EXISTS long_tables;
+        CREATE TABLE long_tables (table_name TEXT PRIMARY KEY,
+                                  time_format TEXT NOT NULL);
+        """.format(sites=sites_table, obs=obs_table))
+
+
+def create_long_indices(con, table_name):
+    con.execute('CREATE INDEX IF NOT EXISTS {0}_site_time ON {0} (site_id, epoch_seconds);'.format(
+        table_name))
+    con.execute('CREATE INDEX IF NOT EXISTS {0}_time ON {0} (epoch_seconds);'.format(table_name))
+
+
+def migrate_sites(con):
+    """
+    give every site in 'sites_list' and 'all_data' an integer id
+    :return: dictionary of site_name -> site_id
+    """
+    sites = get_data_frame_from_table('sites_list', columns=['site_name', 'x', 'y', 'src'])
+    obs_sites = pd.read_sql('SELECT site_name, x, y, src FROM all_data GROUP BY site_name;', con)
+    sites = pd.concat([sites, obs_sites[~obs_sites.site_name.isin(sites.site_name)]],
+                      ignore_index=True)
+    sites['x'] = pd.to_numeric(sites['x'])
+    sites['y'] = pd.to_numeric(sites['y'])
+    sites['site_id'] = np.arange(len(sites))
+    con.executemany('INSERT INTO {} (site_id, site_name, x, y, src) VALUES (?, ?, ?, ?, ?);'.format(
+        sites_table), sites[['site_id', 'site_name', 'x', 'y', 'src']].values.tolist())
+    return dict(zip(sites.site_name, sites.site_id))
+
+
+def migrate_all_data(con, site_ids, chunksize=500000):
+    # stream 'all_data' into the long table so memory stays bounded by the chunk size
+    reader = pd.read_sql('SELECT site_name, datetime, precip_mm, src FROM all_data;', con,
+                         chunksize=chunksize)
+    n = 0
+    for chunk in reader:
+        rows = zip(chunk.site_name.map(site_ids).astype(int).tolist(),
+                   to_epoch(chunk.datetime).tolist(),
+                   chunk.precip_mm.astype(float).tolist(),
+                   chunk.src.tolist())
+        con.executemany('INSERT INTO {} VALUES (?, ?, ?, ?);'.format(obs_table), rows)
+        n += len(chunk)
+        print 'migrated {} rows of all_data'.format(n)
+    create_long_indices(con, obs_table)
+
+
+def migrate_wide_table(con, table_name, site_ids):
+    """
+    store one of the wide summary tables (one column per time step) in long format
+    """
+    wide = get_data_frame_from_table(table_name)
+    time_cols = [c for c in wide.columns if c not in ['index', 'site_name', 'x', 'y', 'src']]
+    time_format = '%Y-%m-%d' if all(len(c) == 10 for c in time_cols) else '%Y-%m-%d %H:%M:%S'
+    long_df = pd.melt(wide, id_vars=['site_name'], value_vars=list(time_cols),
+                      var_name='time', value_name='precip_mm')
+    rows = zip(long_df.site_name.map(site_ids).astype(int).tolist(),
+               to_epoch(long_df.time).tolist(),
+               long_df.precip_mm.astype(float).tolist())
+
+    long_name = long_table_name(table_name)
+    con.execute('DROP TABLE IF EXISTS {};'.format(long_name))
+    con.execute('CREATE TABLE {} (site_id INTEGER NOT NULL, epoch_seconds INTEGER NOT NULL, '
+                'precip_mm REAL);'.format(long_name))
+    con.executemany('INSERT INTO {} VALUES (?, ?, ?);'.format(long_name), rows)
+    con.execute('INSERT INTO long_tables VALUES (?, ?);', (table_name, time_format))
+    create_long_indices(con, long_name)
+    print 'migrated {} ({} values)'.format(table_name, len(rows))
+
+
+def migrate(tables=wide_tables):
+    """
+    build the long-format tables and their indices; the inserts run in one transaction
+    :param tables: wide summary tables to migrate next to 'all_data'
+    """
+    con = get_db_connection()
+    with con:
+        create_long_schema(con)
+        site_ids = migrate_sites(con)
+        migrate_all_data(con, site_ids)
+        for table_name in tables:
+            migrate_wide_table(con, table_name, site_ids)
+    con.execute('ANALYZE;')
+    clear_table_cache()
+
+
+def read_obs_window(start, end, site_names=None, src=None):
+    """
+    read the observations in [start, end) with the same columns as 'all_data'
+    :param start: start of the window (local time)
+    :param end: end of the window (local time)
+    :param site_names: optional list of sites to read
+    :param src: optional source name or list of source names
+    :return: data frame with 'site_name', 'datetime', 'precip_mm', 'x', 'y' and 'src' columns
+    """
+    sql = 'SELECT s.site_name, o.epoch_seconds, o.precip_mm, s.x, s.y, o.src ' \
+          'FROM {} o JOIN {} s ON o.site_id = s.site_id ' \
+          'WHERE o.epoch_seconds >= ? AND o.epoch_seconds < ?'.format(obs_table, sites_table)
+    params = [int(to_epoch(start)), int(to_epoch(end))]
+    if site_names is not None:
+        sql += ' AND s.site_name IN ({})'.format(', '.join('?' * len(site_names)))
+        params.extend(site_names)
+    if src is not None:
+        srcs = [src] if isinstance(src, basestring) else list(src)
+        sql += ' AND o.src IN ({})'.format(', '.join('?' * len(srcs)))
+        params.extend(srcs)
+    df = pd.read_sql(sql + ' ORDER BY o.epoch_seconds;', get_db_connection(), params=params)
+    df.insert(1, 'datetime', from_epoch(df.pop('epoch_seconds')))
+    return df
+
+
+def read_wide(table_name, start=None, end=None):
+    """
+    pivot a long summary table back to the wide layout of the original table
+    :param table_name: 'fif', 'hr' or 'daily'
+    :param start: optional first time step to include
+    :param end: optional time step to stop before
+    :return: data frame with 'site_name', 'x', 'y', 'src' and one column per time step
+    """
+    con = get_db_connection()
+    time_format = con.execute('SELECT time_format FROM long_tables WHERE table_name = ?;',
+                              (table_name,)).fetchone()[0]
+    sql = 'SELECT site_id, epoch_seconds, precip_mm FROM {}'.format(long_table_name(table_name))
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('epoch_seconds >= ?')
+        params.append(int(to_epoch(start)))
+    if end is not None:
+        conditions.append('epoch_seconds < ?')
+        params.append(int(to_epoch(end)))
+    if conditions:
+        sql += ' WHERE {}'.format(' AND '.join(conditions))
+    long_df = pd.read_sql(sql + ';', con, params=params)
+    wide = long_df.pivot(index='site_id', columns='epoch_seconds', values='precip_mm')
+    wide.columns = from_epoch(wide.columns).strftime(time_format)
+
+    sites = pd.read_sql('SELECT site_id, site_name, x, y, src FROM {};'.format(sites_table), con)
+    sites = sites.set_index('site_id')
+    wide = sites.join(wide, how='inner')
+    return wide.reset_index(drop=True)
+
+
+def regenerate_wide_table(table_name):
+    # write the pivot back as the physical wide table for readers that still expect it
+    wide = read_wide(table_name).set_index('site_name')
+    update_table(table_name, wide)
+    return wide
+
+
+if __name__ == '__main__':
+    migrate()
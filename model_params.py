@@ -0,0 +1,107 @@
+# Purpose: Registry of the fitted variogram parameters of a time resolution. The
+# '<tpe>_model_params' table is read once into typed arrays with a timestamp index, instead of
+# once per kriging iteration
+
+import numpy as np
+import pandas as pd
+from storm_stats_functions import get_data_frame_from_table, get_db_version
+
+# kriging settings that are not in the model params tables
+default_nugget = "0"
+default_lag_size = "1000.000000"
+default_sample_num = "27"
+default_sample_type = "Variable"
+
+# registries by table name, rebuilt when the database changes (see get_param_registry)
+_registries = {}
+
+
+class ModelParams:
+    def __init__(self, model_type, rng, sill, nugget=default_nugget, lag_size=default_lag_size,
+                 sample_num=default_sample_num, sample_type=default_sample_type):
+        """
+        variogram and search settings of one time step, as passed to arcpy.gp.Kriging_sa
+        """
+        self.model_type = model_type
+        self.lag_size = lag_size
+        self.range = rng
+        self.sill = sill
+        self.nugget = nugget
+        self.sample_num = sample_num
+        self.sample_type = sample_type
+
+
+class ParamRegistry:
+    def __init__(self, tpe):
+        """
+        all variogram parameters of a time resolution
+        :param tpe: 'fif' (or 'fifteen_min'), 'hr', 'daily' or one of their '_zeroes' variants
+        """
+        if tpe == 'fifteen_min':
+            tpe = 'fif'
+        self.table = "{}_model_params".format(tpe)
+        param_df = get_data_frame_from_table(self.table)
+        self.dates = param_df['date'].values.astype(str)
+        self.time_stamps = pd.to_datetime(self.dates).values
+        self.types = param_df['type'].values.astype(str)
+        self.ranges = param_df['range'].values.astype(float)
+        self.sills = param_df['sill'].values.astype(float)
+        if 'nugget' in param_df.columns:
+            self.nuggets = param_df['nugget'].values.astype(float)
+        else:
+            self.nuggets = np.full(len(param_df), float(default_nugget))
+        self.has_nugget = 'nugget' in param_df.columns
+        self._pos = dict((d, i) for i, d in enumerate(self.dates))
+        self._ns_pos = dict((t, i) for i, t in enumerate(self.time_stamps.astype(np.int64)))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def position(self, d):
+        # row of a date given as stored in the table or as anything pd.Timestamp understands
+        i = self._pos.get(d) if isinstance(d, basestring) else None
+        if i is None:
+            i = self._ns_pos[pd.Timestamp(d).value]
+        return i
+
+    def __contains__(self, d):
+        try:
+            self.position(d)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __getitem__(self, d):
+        """
+        :return: ModelParams of a date
+        """
+        i = self.position(d)
+        nugget = "{}".format(self.nuggets[i]) if self.has_nugget else default_nugget
+        return ModelParams(self.types[i], self.ranges[i], self.sills[i], nugget)
+
+    def positions(self, dates):
+        return np.array([self.position(d) for d in dates], dtype=int)
+
+    def to_frame(self, dates=None):
+        """
+        parameters of many dates at once, for the batched kriging engines
+        :param dates: optional dates to select (all by default)
+        :return: data frame indexed by date with 'type', 'range', 'sill' and 'nugget' columns
+        """
+        pos = np.arange(len(self)) if dates is None else self.positions(dates)
+        return pd.DataFrame({'type': self.types[pos],
+                             'range': self.ranges[pos],
+                             'sill': self.sills[pos],
+                             'nugget': self.nuggets[pos]},
+                            index=pd.Index(self.dates[pos], name='date'),
+                            columns=['type', 'range', 'sill', 'nugget'])
+
+
+def get_param_registry(tpe):
+    """
+    the registry of a time resolution, loaded once per process and database version
+    """
+    version = get_db_version()
+    if tpe not in _registries or _registries[tpe][0] != version:
+        _registries[tpe] = (version, ParamRegistry(tpe))
+    return _registries[tpe][1]
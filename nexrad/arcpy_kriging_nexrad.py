@@ -1,7 +1,15 @@
+import random
+import string
 import arcpy
 from arcpy import env
+import numpy as np
 import pandas as pd
 from precipitation_processing.storm_stats_functions import check_dir, get_data_frame_from_table, data_dir
+from precipitation_processing.kriging import gauge_points
+from precipitation_processing.model_params import get_param_registry
+from precipitation_processing.gauge_network import GaugeNetwork
+from precipitation_processing.nexrad.nexrad_index import get_nexrad_index
+from precipitation_processing.nexrad.reprojection import watershed_means
 import shutil
 import os
 import psutil
@@ -9,32 +17,12 @@ import stat
 import datetime
 
 
-class ModelParams:
-    def __init__(self, tpe, d):
-        if tpe == 'fifteen_min':
-            tpe = 'fif'
-        table = "{}_model_params".format(tpe)
-        param_df = get_data_frame_from_table(table)
-        param_df.set_index('date', inplace=True)
-
-        self.model_type = param_df['type'][d]
-        self.lag_size = "1000.000000"
-        self.range = param_df['range'][d]
-        self.sill = param_df['sill'][d]
-        self.nugget = "0"  # todo get this from R script
-        self.sample_num = "27"  # todo make this dynamic?
-        self.krad = arcpy.sa.RadiusVariable(27, 20000)
-        self.sample_type = "Variable"
-
-
-def take_out_gages(df, x, y, k):
-    df['dist'] = ((df['x'] - x) ** 2 + (df['y'] - y) ** 2) ** 0.5
-    df = df.sort_values('dist')
-    df = df.reset_index()
-    dists = [df.ix[i, 'dist'] for i in range(k)]
-    stations_removed = [df.ix[i, 'site_name'] for i in range(k)]
-    df = df.ix[k:]
-    return df, dists, stations_removed
+def take_out_gages(df, network, x, y, k):
+    # remove the k gauges nearest to (x, y); network is the GaugeNetwork of df's rows
+    dists, ids = network.nearest((x, y), k)
+    stations_removed = network.site_names[ids].tolist()
+    df = df.iloc[np.setdiff1d(network.site_ids, ids)]
+    return df, dists.tolist(), stations_removed
 
 
 def change_permissions_recursive(path):
@@ -128,54 +116,27 @@ def raster_mean_under_plygn(plygn, raster):
         return None
 
 
-def make_date_shapefile(date, df):
-    # convert to excel then to table then to layer then to shapefile... phew!
-    date_df = df[['site_name', 'x', 'y', 'src', date]]  # get df for individual timestep
-    date_df = date_df[date_df[date].notnull()]
-    date_df.columns = ['site_name', 'x', 'y', 'src', 'z']
-    global k_dir
-    date_table = "{}/temp.xls".format(k_dir)
-    date_df.to_excel(date_table, index=False)
-
-    tbl = "tab.dbf"
-
-    arcpy.ExcelToTable_conversion(date_table, tbl, Sheet="Sheet1")
-
-    spref = r"Coordinate Systems/Projected Coordinate Systems/State Plane/Nad 1983/" \
-            r"NAD 1983 HARN StatePlane Virginia South FIPS 4502 (Meters).prj"
-    lyr = "Layer"
-    arcpy.MakeXYEventLayer_management(tbl, 'x', 'y', lyr, spref)
-
-    shp = 'temp.shp'
-    arcpy.CopyFeatures_management(lyr, shp)
-    arcpy.Delete_management(date_table)
-    arcpy.Delete_management(tbl)
-    return shp
+def make_date_points(date, df, debug_shp=False):
+    # hand the gauges of a time step to arcpy as an in-memory feature class
+    xy, z, site_names = gauge_points(df, date)
+    pts = np.zeros(len(z), dtype=[('x', 'f8'), ('y', 'f8'), ('z', 'f8')])
+    pts['x'] = xy[:, 0]
+    pts['y'] = xy[:, 1]
+    pts['z'] = z
+    spref = arcpy.SpatialReference("NAD 1983 HARN StatePlane Virginia South FIPS 4502 (Meters)")
+    rand_str = "".join(random.choice(string.lowercase) for i in range(4))
+    fc = "in_memory/pts_{}".format(rand_str)
+    arcpy.da.NumPyArrayToFeatureClass(pts, fc, ('x', 'y'), spref)
+    if debug_shp:
+        # keep a shapefile of the points for debugging
+        arcpy.CopyFeatures_management(fc, 'temp_{}.shp'.format(rand_str))
+    return fc
 
 
 def get_nexrad_file(ts):
-    ts_utc = ts + datetime.timedelta(hours=5)
-    # check for daylight savings:
-    if (datetime.datetime(2016, 03, 13) > ts_utc > datetime.datetime(2015, 11, 01))\
-            or (datetime.datetime(2015, 03, 8) > ts_utc > datetime.datetime(2014, 11, 02)) \
-            or (datetime.datetime(2014, 03, 8) > ts_utc > datetime.datetime(2013, 11, 03)):
-        ts_utc += datetime.timedelta(hours=1)
-
-    d = os.path.join(data_dir, "nexrad/{}".format(ts.strftime('%Y%m%d')))
-    files = os.listdir(d)
-    nexrad_time_strings = [t.split("_")[-2] + t.split("_")[-1] for t in files]
-    nexrad_time_strings_cln = [t.split(".")[0] for t in nexrad_time_strings]
-    nexrad_times = [datetime.datetime.strptime(t, "%Y%m%d%H%M%S") for t in nexrad_time_strings_cln]
-    time_diff = datetime.timedelta(hours=1)
-    for i in range(len(nexrad_times)):
-        diff = ts_utc - nexrad_times[i]
-        if abs(time_diff.total_seconds()) > abs(diff.total_seconds()):
-            time_diff = diff
-            nex_file = files[i]
-    try:
-        return os.path.join(d, nex_file)
-    except UnboundLocalError:
-        return None
+    # closest scan within an hour of a local time step
+    index = get_nexrad_index(os.path.join(data_dir, "nexrad"))
+    return index.nearest_local(ts, max_diff=datetime.timedelta(hours=1))
 
 
 # specify type; should be 'fifteen_min', 'hr', or 'daily'
@@ -185,6 +146,7 @@ tpe = 'hr'
 df = get_data_frame_from_table('hr')
 a = df.ix[:, 4:]
 non_zero_dates = a.columns[a.sum() > 0]
+params = get_param_registry(tpe)
 
 # set up arcpy environment
 arcpy.CheckOutExtension("spatial")
@@ -220,10 +182,10 @@ for date in non_zero_dates:
     timestamp = datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
 
     check_dir(k_dir)
-    rain_shp = make_date_shapefile(date, df)
+    rain_shp = make_date_points(date, df)
 
     #  get model params
-    mp = ModelParams(tpe, date)
+    mp = params[date]
 
     # do kriging
     out_est_file = "rainEst"
@@ -236,10 +198,10 @@ for date in non_zero_dates:
                         cell_size,
                         "{} {}".format(mp.sample_type, mp.sample_num),
                         out_var_file)
-    nexrad_raster = "nex_prjd.tif"
+    # nexrad means of all watersheds at once with the cached resampling and zonal weights
     nexrad_file_name = get_nexrad_file(timestamp)
     if nexrad_file_name:
-        arcpy.ProjectRaster_management(nexrad_file_name, nexrad_raster, out_est_file, "BILINEAR")
+        nexrad_means = watershed_means([nexrad_file_name], shed_ply)[0]
     for i in [0, 1, 2, 3, 4, 5, 6]:
         # select individual watershed
         sel = "selection{}.shp".format(i)
@@ -261,7 +223,7 @@ for date in non_zero_dates:
 
         # get mean of nexrad data
         if nexrad_file_name:
-            nexrad_est_in = raster_mean_under_plygn(plygn=sel, raster=nexrad_raster)
+            nexrad_est_in = nexrad_means[i] if np.isfinite(nexrad_means[i]) else None
             nexrad_file_name = nexrad_file_name.split("\\")[-1]
         else:
             nexrad_est_mm = None
@@ -285,7 +247,6 @@ for date in non_zero_dates:
     print "time step: {}".format(j)
     hd = False
 
-    arcpy.Delete_management(nexrad_raster)
     arcpy.Delete_management(out_var_file)
     arcpy.Delete_management(out_est_file)
     arcpy.Delete_management(rain_shp)
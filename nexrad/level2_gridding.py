@@ -0,0 +1,235 @@
+# Purpose: Rain rate on the study grid from the lowest reflectivity sweep of NEXRAD Level II
+# volumes. The grid cells are mapped to the radar's (azimuth bin, gate) space once per radar site
+# and grid; after that gridding a scan is one sparse matrix product
+
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
+from precipitation_processing.storm_stats_functions import data_dir, check_dir
+from precipitation_processing.kriging import Grid
+from precipitation_processing.nexrad.nexrad_index import scan_epoch
+
+try:
+    import pyart
+except ImportError:
+    pyart = None
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+cache_dir = os.path.join(data_dir, 'cache', 'nexrad_lookup')
+
+# NAD83(HARN) / Virginia South (m), the coordinate system of the gauges and the study grid
+grid_epsg = 2854
+
+# Lambert conformal conic parameters of Virginia South (GRS80), used when pyproj is missing
+lcc_params = {'a': 6378137., 'f': 1 / 298.257222101, 'lat_1': 36.766666667,
+              'lat_2': 37.966666667, 'lat_0': 36.333333333, 'lon_0': -78.5,
+              'x_0': 3500000., 'y_0': 1000000.}
+
+# effective earth radius (4/3 model) for the beam geometry
+effective_radius = 4. / 3 * 6371000.
+
+# lookup tables by key, shared by all scans of a process (see get_lookup)
+_lookups = {}
+
+
+def check_pyart():
+    if pyart is None:
+        raise ImportError('pyart is needed to read NEXRAD Level II files')
+
+
+def lcc_inverse(x, y, p=lcc_params):
+    """
+    State Plane coordinates to longitude and latitude (degrees) with the ellipsoidal Lambert
+    conformal conic formulas (Snyder 1987)
+    """
+    e = np.sqrt(p['f'] * (2 - p['f']))
+    a = p['a']
+
+    def m(phi):
+        return np.cos(phi) / np.sqrt(1 - (e * np.sin(phi)) ** 2)
+
+    def t(phi):
+        return np.tan(np.pi / 4 - phi / 2) / ((1 - e * np.sin(phi)) / (1 + e * np.sin(phi))) ** (e / 2)
+
+    phi1, phi2, phi0 = [np.radians(p[k]) for k in ('lat_1', 'lat_2', 'lat_0')]
+    n = (np.log(m(phi1)) - np.log(m(phi2))) / (np.log(t(phi1)) - np.log(t(phi2)))
+    big_f = m(phi1) / (n * t(phi1) ** n)
+    rho0 = a * big_f * t(phi0) ** n
+
+    dx = np.asarray(x, dtype=float) - p['x_0']
+    dy = rho0 - (np.asarray(y, dtype=float) - p['y_0'])
+    rho = np.sign(n) * np.hypot(dx, dy)
+    tt = (rho / (a * big_f)) ** (1 / n)
+    theta = np.arctan2(dx, dy)
+    lon = np.degrees(theta / n) + p['lon_0']
+    phi = np.pi / 2 - 2 * np.arctan(tt)
+    for i in range(10):
+        phi = np.pi / 2 - 2 * np.arctan(tt * ((1 - e * np.sin(phi)) / (1 + e * np.sin(phi))) ** (e / 2))
+    return lon, np.degrees(phi)
+
+
+def grid_lon_lat(grid):
+    # longitude and latitude of the cell centers, in row-major order
+    xy = grid.cell_centers()
+    if pyproj is None:
+        return lcc_inverse(xy[:, 0], xy[:, 1])
+    if hasattr(pyproj, 'Transformer'):
+        transformer = pyproj.Transformer.from_crs(grid_epsg, 4326, always_xy=True)
+        return transformer.transform(xy[:, 0], xy[:, 1])
+    return pyproj.Proj(init='epsg:{}'.format(grid_epsg))(xy[:, 0], xy[:, 1], inverse=True)
+
+
+def radar_geometry(radar, sweep=0):
+    """
+    :return: (site, latitude, longitude, elevation angle, range of the first gate, gate spacing,
+    number of gates, azimuth resolution) of a sweep
+    """
+    az = np.sort(radar.azimuth['data'][radar.get_slice(sweep)])
+    az_res = 0.5 if np.median(np.diff(az)) < 0.75 else 1.
+    rng = radar.range['data']
+    return (str(radar.metadata.get('instrument_name', '')),
+            round(float(radar.latitude['data'][0]), 4),
+            round(float(radar.longitude['data'][0]), 4),
+            round(float(radar.fixed_angle['data'][sweep]), 1),
+            float(rng[0]), float(rng[1] - rng[0]), len(rng), az_res)
+
+
+def build_lookup(geometry, grid):
+    """
+    bilinear weights in (azimuth, range) space of the gates around every grid cell center
+    :param geometry: see radar_geometry
+    :return: csr matrix of shape (grid.size, number of azimuth bins * number of gates); rows of
+    cells beyond the last gate are empty
+    """
+    site, lat, lon, elevation, r0, dr, n_gates, az_res = geometry
+    n_az = int(round(360. / az_res))
+    cell_lon, cell_lat = grid_lon_lat(grid)
+
+    # azimuth and ground distance of the cells from the radar on a sphere of the local radius
+    phi1, phi2 = np.radians(lat), np.radians(cell_lat)
+    dlon = np.radians(np.asarray(cell_lon) - lon)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlon / 2) ** 2
+    e2 = lcc_params['f'] * (2 - lcc_params['f'])
+    radius = lcc_params['a'] * np.sqrt(1 - e2) / (1 - e2 * np.sin(phi1) ** 2)
+    s = 2 * radius * np.arcsin(np.sqrt(a))
+    az = np.degrees(np.arctan2(np.sin(dlon) * np.cos(phi2), np.cos(phi1) * np.sin(phi2) -
+                               np.sin(phi1) * np.cos(phi2) * np.cos(dlon))) % 360.
+
+    # slant range of the beam at that ground distance
+    el = np.radians(elevation)
+    tan_s = np.tan(s / effective_radius)
+    r = effective_radius * tan_s / (np.cos(el) - np.sin(el) * tan_s)
+
+    # fractional azimuth bin (bins are [k res, (k + 1) res)) and gate index
+    fa = az / az_res - 0.5
+    fg = (r - r0) / dr
+    a0 = np.floor(fa).astype(int)
+    g0 = np.floor(fg).astype(int)
+    wa = fa - a0
+    wg = fg - g0
+    ok = (fg >= 0) & (fg <= n_gates - 1)
+    cells = np.arange(grid.size)
+    rows, cols, vals = [], [], []
+    for da, w_a in ((0, 1 - wa), (1, wa)):
+        for dg, w_g in ((0, 1 - wg), (1, wg)):
+            g = np.clip(g0 + dg, 0, n_gates - 1)
+            rows.append(cells[ok])
+            cols.append(((a0[ok] + da) % n_az) * n_gates + g[ok])
+            vals.append((w_a * w_g)[ok])
+    return sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(grid.size, n_az * n_gates))
+
+
+def cache_file(geometry, grid, dty=cache_dir):
+    key = repr((geometry, grid.key(), grid_epsg))
+    return os.path.join(dty, 'lookup_{}_{}.npz'.format(geometry[0], hashlib.md5(key).hexdigest()))
+
+
+def get_lookup(geometry, grid, dty=cache_dir):
+    """
+    the lookup table of a radar geometry and grid, from memory, the disk cache or built new
+    """
+    key = (geometry, grid.key())
+    if key in _lookups:
+        return _lookups[key]
+    f = cache_file(geometry, grid, dty)
+    if os.path.exists(f):
+        npz = np.load(f)
+        weights = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                                    shape=tuple(npz['shape']))
+    else:
+        weights = build_lookup(geometry, grid)
+        check_dir(dty)
+        np.savez(f, data=weights.data, indices=weights.indices, indptr=weights.indptr,
+                 shape=weights.shape)
+    _lookups[key] = weights
+    return weights
+
+
+def rain_rate(dbz, a=300., b=1.4, max_dbz=53.):
+    """
+    rain rate (mm/h) from reflectivity (dBZ) with Z = a R^b. reflectivity is capped at max_dbz
+    (hail cap) and masked gates (no echo) are no rain
+    """
+    dbz = np.ma.filled(np.ma.masked_invalid(dbz).astype(float), -np.inf)
+    z = 10. ** (np.minimum(dbz, max_dbz) / 10.)
+    return (z / a) ** (1. / b)
+
+
+def rays_to_polar(az, values, az_res):
+    """
+    :param az: (rays,) azimuths of the sweep
+    :param values: (rays x gates) values
+    :return: (azimuth bins x gates) array, NaN for bins without a ray
+    """
+    n_az = int(round(360. / az_res))
+    polar = np.full((n_az, values.shape[1]), np.nan)
+    polar[(np.floor(np.asarray(az) / az_res).astype(int)) % n_az] = values
+    return polar
+
+
+def grid_scan(path, grid=None, dty=cache_dir):
+    """
+    :param path: Level II volume file
+    :return: scan time (seconds since 1970-01-01 UTC, from the file name) and rain rate grid
+    (mm/h, float32, NaN beyond the radar's range)
+    """
+    check_pyart()
+    grid = grid or Grid()
+    radar = pyart.io.read_nexrad_archive(path, scans=[0])
+    geometry = radar_geometry(radar)
+    weights = get_lookup(geometry, grid, dty)
+    sweep = radar.get_slice(0)
+    rate = rain_rate(radar.fields['reflectivity']['data'][sweep])
+    polar = rays_to_polar(radar.azimuth['data'][sweep], rate, geometry[-1]).ravel()
+    finite = np.isfinite(polar)
+    num = weights.dot(np.where(finite, polar, 0.))
+    den = weights.dot(finite.astype(float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate_grid = (num / den).astype(np.float32)
+    return scan_epoch(os.path.basename(path)), rate_grid.reshape(grid.shape)
+
+
+def grid_scans(paths, grid=None, dty=cache_dir):
+    """
+    :param paths: Level II files (e.g. the scans of a day from NexradIndex.within)
+    :return: (scans,) scan times and (scans x rows x cols) float32 stack of rain rates (mm/h)
+    """
+    grid = grid or Grid()
+    epochs = np.zeros(len(paths), dtype=np.int64)
+    stack = np.empty((len(paths),) + grid.shape, dtype=np.float32)
+    for i, path in enumerate(paths):
+        epochs[i], stack[i] = grid_scan(path, grid, dty)
+    return epochs, stack
+
+
+def grid_directory(dty, grid=None):
+    # grid all the scans in a directory (e.g. one day of the archive) in time order
+    paths = [os.path.join(dty, f) for f in os.listdir(dty) if scan_epoch(f) is not None]
+    paths.sort(key=lambda p: scan_epoch(os.path.basename(p)))
+    return grid_scans(paths, grid)
@@ -0,0 +1,144 @@
+# Purpose: Time index of the local NEXRAD archive (one directory per day, file names ending in
+# _YYYYMMDD_HHMMSS.<ext> in UTC). The scan times are kept in a sorted array so the nearest scan and
+# the scans in a window are found by bisection. The index is saved in the archive and only the day
+# directories that changed since the last refresh are read again
+
+import os
+import json
+import datetime
+import calendar
+import numpy as np
+import pytz
+
+local_tz = pytz.timezone('America/New_York')
+index_name = 'nexrad_index.json'
+
+# indices by archive root, built on first use (see get_nexrad_index)
+_indices = {}
+
+
+def scan_epoch(file_name):
+    """
+    :param file_name: NEXRAD file name like KAKQ_..._20150930_123456.gz
+    :return: scan time in seconds since 1970-01-01 UTC or None if the name has no time stamp
+    """
+    parts = os.path.splitext(file_name)[0].split('_')
+    if len(parts) < 3:
+        return None
+    try:
+        t = datetime.datetime.strptime(parts[-2] + parts[-1].split('.')[0], '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+    return calendar.timegm(t.timetuple())
+
+
+def local_to_epoch(ts, tz=local_tz):
+    """
+    :param ts: naive local wall-clock time (like the gauge time stamps)
+    :return: seconds since 1970-01-01 UTC. ambiguous times at the end of daylight saving time are
+    taken as standard time
+    """
+    utc = tz.localize(ts, is_dst=False).astimezone(pytz.utc)
+    return calendar.timegm(utc.timetuple())
+
+
+class NexradIndex:
+    def __init__(self, root, index_file=None):
+        """
+        :param root: directory holding the day directories of the archive
+        :param index_file: where the index is saved (in root by default)
+        """
+        self.root = root
+        self.index_file = index_file or os.path.join(root, index_name)
+        self.dirs = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.dirs = json.load(f)
+        self.epochs = np.zeros(0, dtype=np.int64)
+        self.paths = []
+        self.refresh()
+
+    def refresh(self):
+        """
+        read the day directories that are new or changed (by mtime) since the last refresh, drop
+        the ones that are gone and rebuild the sorted arrays
+        :return: True if anything changed
+        """
+        changed = False
+        present = set()
+        for d in os.listdir(self.root):
+            path = os.path.join(self.root, d)
+            if not os.path.isdir(path):
+                continue
+            present.add(d)
+            mtime = os.path.getmtime(path)
+            if d in self.dirs and self.dirs[d]['mtime'] == mtime:
+                continue
+            scans = []
+            for f in os.listdir(path):
+                epoch = scan_epoch(f)
+                if epoch is not None:
+                    scans.append([epoch, f])
+            self.dirs[d] = {'mtime': mtime, 'scans': scans}
+            changed = True
+        for d in set(self.dirs) - present:
+            del self.dirs[d]
+            changed = True
+
+        if changed or len(self.paths) == 0:
+            scans = sorted((epoch, os.path.join(d, f)) for d in self.dirs
+                           for epoch, f in self.dirs[d]['scans'])
+            self.epochs = np.array([s[0] for s in scans], dtype=np.int64)
+            self.paths = [s[1] for s in scans]
+        if changed:
+            tmp_file = '{}.tmp'.format(self.index_file)
+            with open(tmp_file, 'w') as f:
+                json.dump(self.dirs, f)
+            if os.path.exists(self.index_file):
+                os.remove(self.index_file)
+            os.rename(tmp_file, self.index_file)
+        return changed
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def nearest(self, epoch, max_diff=None):
+        """
+        :param epoch: time in seconds since 1970-01-01 UTC
+        :param max_diff: optional datetime.timedelta the scan must be closer than
+        :return: full path of the scan closest in time (the earlier one on a tie) or None
+        """
+        i = np.searchsorted(self.epochs, epoch)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(self.epochs)]
+        if not candidates:
+            return None
+        j = min(candidates, key=lambda c: abs(self.epochs[c] - epoch))
+        if max_diff is not None and abs(self.epochs[j] - epoch) >= max_diff.total_seconds():
+            return None
+        return os.path.join(self.root, self.paths[j])
+
+    def within(self, start, end):
+        """
+        :return: full paths of the scans in [start, end] (seconds since 1970-01-01 UTC), in time
+        order
+        """
+        i0 = np.searchsorted(self.epochs, start, side='left')
+        i1 = np.searchsorted(self.epochs, end, side='right')
+        return [os.path.join(self.root, p) for p in self.paths[i0:i1]]
+
+    def nearest_local(self, ts, max_diff=None):
+        # nearest scan to a naive local (America/New_York) time
+        return self.nearest(local_to_epoch(ts), max_diff)
+
+    def within_local(self, start, end):
+        return self.within(local_to_epoch(start), local_to_epoch(end))
+
+
+def get_nexrad_index(root):
+    """
+    the index of an archive, loaded (and refreshed from disk) once per process; call refresh() on
+    it to pick up scans downloaded later
+    """
+    if root not in _indices:
+        _indices[root] = NexradIndex(root)
+    return _indices[root]
@@ -0,0 +1,147 @@
+# Purpose: Bilinear resampling of the NEXRAD rasters onto the kriging grid without
+# arcpy.ProjectRaster_management. The source cell indices and weights of every grid cell are
+# computed once per source grid, cached on disk and applied to each raster as a gather-multiply
+
+import os
+import hashlib
+import numpy as np
+from precipitation_processing.storm_stats_functions import data_dir, check_dir
+from precipitation_processing.kriging import Grid
+from precipitation_processing.zonal_stats import get_zonal_weights, zonal_means
+from precipitation_processing.nexrad.level2_gridding import grid_lon_lat, grid_epsg, pyproj
+
+try:
+    import rasterio
+except ImportError:
+    rasterio = None
+
+cache_dir = os.path.join(data_dir, 'cache', 'nexrad_resample')
+
+# resampling weights by key, shared by all rasters of a process (see get_weights)
+_weights = {}
+
+
+def check_rasterio():
+    if rasterio is None:
+        raise ImportError('rasterio is needed to read the NEXRAD rasters')
+
+
+def source_grid(src):
+    """
+    :param src: open rasterio dataset (north up)
+    :return: ((x of the left edge, cell width, y of the top edge, cell height), width, height,
+    crs string) of its grid. the crs is '' for longitude and latitude (the NEXRAD products)
+    """
+    t = src.transform
+    crs = '' if src.crs is None or src.crs.is_geographic else src.crs.to_string()
+    return (t.c, t.a, t.f, t.e), src.width, src.height, crs
+
+
+def target_coords(grid, crs):
+    # cell centers of the grid in the coordinates of the source raster
+    if not crs:
+        return grid_lon_lat(grid)
+    if pyproj is None or not hasattr(pyproj, 'Transformer'):
+        raise ImportError('pyproj 2 is needed for source rasters in {}'.format(crs))
+    xy = grid.cell_centers()
+    transformer = pyproj.Transformer.from_crs(grid_epsg, crs, always_xy=True)
+    return transformer.transform(xy[:, 0], xy[:, 1])
+
+
+def bilinear_weights(src_grid, grid):
+    """
+    indices and weights of the 4 source cells around every grid cell center (like the
+    "BILINEAR" option of ProjectRaster)
+    :param src_grid: see source_grid
+    :return: (grid.size x 4) flat source indices, (grid.size x 4) float32 weights and a mask of
+    the grid cells inside the source raster
+    """
+    (x0, dx, y0, dy), width, height, crs = src_grid
+    x, y = target_coords(grid, crs)
+    fc = (np.asarray(x) - x0) / dx - 0.5
+    fr = (np.asarray(y) - y0) / dy - 0.5
+    valid = (fc >= 0) & (fc <= width - 1) & (fr >= 0) & (fr <= height - 1)
+    c0 = np.clip(np.floor(fc).astype(int), 0, max(width - 2, 0))
+    r0 = np.clip(np.floor(fr).astype(int), 0, max(height - 2, 0))
+    wc = np.clip(fc - c0, 0., 1.)
+    wr = np.clip(fr - r0, 0., 1.)
+    c1 = np.minimum(c0 + 1, width - 1)
+    r1 = np.minimum(r0 + 1, height - 1)
+    idx = np.column_stack([r0 * width + c0, r0 * width + c1, r1 * width + c0, r1 * width + c1])
+    w = np.column_stack([(1 - wr) * (1 - wc), (1 - wr) * wc, wr * (1 - wc), wr * wc])
+    idx[~valid] = 0
+    w[~valid] = 0.
+    return idx, w.astype(np.float32), valid
+
+
+def cache_file(src_grid, grid, dty=cache_dir):
+    key = repr((src_grid, grid.key(), grid_epsg))
+    return os.path.join(dty, 'bilinear_{}.npz'.format(hashlib.md5(key).hexdigest()))
+
+
+def get_weights(src_grid, grid=None, dty=cache_dir):
+    """
+    the resampling weights of a source grid onto a grid, from memory, the disk cache or built new
+    """
+    grid = grid or Grid()
+    key = (src_grid, grid.key())
+    if key in _weights:
+        return _weights[key]
+    f = cache_file(src_grid, grid, dty)
+    if os.path.exists(f):
+        npz = np.load(f)
+        weights = npz['idx'], npz['w'], npz['valid']
+    else:
+        weights = bilinear_weights(src_grid, grid)
+        check_dir(dty)
+        np.savez(f, idx=weights[0], w=weights[1], valid=weights[2])
+    _weights[key] = weights
+    return weights
+
+
+def resample(values, weights, grid=None):
+    """
+    :param values: 2d source raster (NaN for NoData)
+    :param weights: see get_weights
+    :return: float32 raster on the grid, NaN outside the source or next to NoData
+    """
+    grid = grid or Grid()
+    idx, w, valid = weights
+    gathered = values.ravel()[idx]
+    out = (np.where(w > 0, gathered, 0.) * w).sum(axis=1).astype(np.float32)
+    out[~valid] = np.nan
+    return out.reshape(grid.shape)
+
+
+def read_resampled(path, grid=None, dty=cache_dir):
+    # band 1 of a raster resampled onto the grid
+    check_rasterio()
+    grid = grid or Grid()
+    with rasterio.open(path) as src:
+        weights = get_weights(source_grid(src), grid, dty)
+        values = src.read(1, masked=True).astype(np.float32).filled(np.nan)
+    return resample(values, weights, grid)
+
+
+def resample_files(paths, grid=None, dty=cache_dir):
+    """
+    :return: (rasters x rows x cols) float32 stack of the rasters resampled onto the grid
+    """
+    grid = grid or Grid()
+    stack = np.empty((len(paths),) + grid.shape, dtype=np.float32)
+    for i, path in enumerate(paths):
+        stack[i] = read_resampled(path, grid, dty)
+    return stack
+
+
+def watershed_means(paths, shed_ply, grid=None):
+    """
+    mean of every raster under every watershed in one pass (no projected copies and no zonal
+    statistics tables)
+    :param paths: NEXRAD rasters
+    :param shed_ply: watershed polygon shapefile
+    :return: (rasters x watersheds) array of means (NaN where a watershed has no data)
+    """
+    grid = grid or Grid()
+    weights = get_zonal_weights(shed_ply, grid)[0]
+    return zonal_means(weights, resample_files(paths, grid))
@@ -0,0 +1,150 @@
+# Purpose: Optional columnar (Arrow IPC) cache of the 'all_data' table, partitioned by month. The
+# partitions are opened memory-mapped, so only the requested months are paged in and nothing is
+# parsed; converting them to pandas still copies the rows. The cache is rebuilt when master.sqlite
+# changes
+
+import os
+import json
+import pandas as pd
+import storm_stats_functions as ssf
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+cache_dir = os.path.join(ssf.data_dir, 'cache', 'all_data')
+manifest_name = 'manifest.json'
+
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is needed for the columnar cache of all_data')
+
+
+def read_manifest(dty=cache_dir):
+    path = os.path.join(dty, manifest_name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_fresh(manifest):
+    return manifest is not None and \
+        manifest['source'] == os.path.abspath(ssf.db_filename) and \
+        manifest['source_mtime'] == ssf.get_db_version()
+
+
+def write_partition(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp_path = '{}.tmp'.format(path)
+    sink = pa.OSFile(tmp_path, 'wb')
+    writer = pa.RecordBatchFileWriter(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+    sink.close()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def build_cache(dty=cache_dir):
+    """
+    write one Arrow file per month of 'all_data' with int64 (datetime64[ns]) timestamps and
+    dictionary encoded site_name and src columns. months are read one at a time so memory is
+    bounded by the largest month
+    :return: the manifest of the new cache
+    """
+    check_pyarrow()
+    ssf.check_dir(dty)
+    version = ssf.get_db_version()
+    con = ssf.get_db_connection()
+    months = [r[0] for r in con.execute(
+        'SELECT DISTINCT substr(datetime, 1, 7) FROM all_data ORDER BY 1;')]
+    site_names = sorted(r[0] for r in con.execute('SELECT DISTINCT site_name FROM all_data;'))
+    srcs = sorted(r[0] for r in con.execute('SELECT DISTINCT src FROM all_data;'))
+
+    partitions = {}
+    for month in months:
+        start = pd.Timestamp('{}-01'.format(month))
+        end = start + pd.DateOffset(months=1)
+        df = ssf.get_data_frame_from_table('all_data', start=start, end=end, use_cache=False)
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        df['site_name'] = pd.Categorical(df['site_name'], categories=site_names)
+        df['src'] = pd.Categorical(df['src'], categories=srcs)
+        file_name = 'all_data_{}.arrow'.format(month)
+        write_partition(df, os.path.join(dty, file_name))
+        partitions[month] = file_name
+
+    # remove partitions of months that are no longer in the database
+    for f in os.listdir(dty):
+        if f.endswith('.arrow') and f not in partitions.values():
+            os.remove(os.path.join(dty, f))
+
+    manifest = {'source': os.path.abspath(ssf.db_filename),
+                'source_mtime': version,
+                'partitions': partitions}
+    with open(os.path.join(dty, manifest_name), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+def get_manifest(dty=cache_dir):
+    # rebuild the cache if it is missing or older than the database
+    manifest = read_manifest(dty)
+    if not is_fresh(manifest):
+        print 'rebuilding columnar cache of all_data in {}'.format(dty)
+        manifest = build_cache(dty)
+    return manifest
+
+
+def read_partition(path):
+    source = pa.memory_map(path, 'r')
+    return pa.ipc.open_file(source).read_all()
+
+
+def empty_frame(manifest, categorical=False, dty=cache_dir):
+    # no rows, with the column types of the cache (datetime64[ns] timestamps)
+    partitions = manifest['partitions']
+    if partitions:
+        table = read_partition(os.path.join(dty, partitions[min(partitions)]))
+        df = table.slice(0, 0).to_pandas()
+    else:
+        df = ssf.get_data_frame_from_table('all_data', dates=[])
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        df['precip_mm'] = df['precip_mm'].astype(float)
+    if not categorical:
+        df['site_name'] = df['site_name'].astype(object)
+        df['src'] = df['src'].astype(object)
+    return df
+
+
+def load_all_data(dates=None, categorical=False, dty=cache_dir):
+    """
+    read 'all_data' from the columnar cache. the partitions are memory-mapped but the returned
+    data frame is a copy of their rows (pyarrow's to_pandas)
+    :param dates: optional list of calendar dates ('YYYY-MM-DD'); only those months are read and
+    only rows on those days are returned
+    :param categorical: keep site_name and src as pandas categoricals instead of strings
+    :return: data frame with the columns of 'all_data' and a parsed 'datetime' column
+    """
+    check_pyarrow()
+    manifest = get_manifest(dty)
+    partitions = manifest['partitions']
+    if dates is not None:
+        days = pd.to_datetime(sorted(set(dates)))
+        months = sorted(set(days.strftime('%Y-%m')) & set(partitions))
+    else:
+        months = sorted(partitions)
+
+    tables = [read_partition(os.path.join(dty, partitions[m])) for m in months]
+    if not tables:
+        return empty_frame(manifest, categorical, dty)
+    df = pa.concat_tables(tables).to_pandas()
+    if dates is not None:
+        df = df[df['datetime'].dt.normalize().isin(days)].reset_index(drop=True)
+    if not categorical:
+        df['site_name'] = df['site_name'].astype(object)
+        df['src'] = df['src'].astype(object)
+    return df
@@ -0,0 +1,224 @@
+# Purpose: Online version of the neighbor outlier check of idw_analysis.py. New observations are
+# summed to 15-minute totals (like the 'fif' table) and checked as they arrive with neighbor lists
+# that are cached per availability pattern, running per-site statistics are updated incrementally
+# and the flags are appended to the 'qc_results' table instead of rewriting it
+
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from storm_stats_functions import get_db_connection, clear_table_cache, aggregate_long
+from idw_analysis import neighbor_lists, idw
+from gauge_network import get_gauge_network
+
+flag_columns = ['ave_distance', 'datetime', 'global_mean', 'index', 'longest_dist', 'neighbors',
+                'num_neighbors', 'out', 'percent_diff', 'pred_val', 'recorded_val',
+                'shortest_dist', 'src', 'true_station']
+
+
+class RunningStats:
+    def __init__(self, n):
+        """
+        count, mean and variance of n series updated one time step at a time (Welford)
+        """
+        self.count = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+
+    def update(self, values):
+        # values: (n,) array, NaN where a series has no new value
+        ok = np.isfinite(values)
+        self.count[ok] += 1
+        delta = values[ok] - self.mean[ok]
+        self.mean[ok] += delta / self.count[ok]
+        self.m2[ok] += delta * (values[ok] - self.mean[ok])
+
+    @property
+    def std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2 / (self.count - 1))
+
+
+class StreamingQC:
+    def __init__(self, network=None, outlier_check=True, latency_budget=1., cache_size=512,
+                 table='qc_results', time_step='15T'):
+        """
+        :param network: GaugeNetwork of the gauges to check (sites_list by default)
+        :param outlier_check: leave the 'wu' gauges out of the neighbors, like
+        analyze_from_neighbors(df, True)
+        :param latency_budget: seconds a time step should take. this is a soft limit: a slower
+        step is still checked completely, it is only counted in overruns and reported
+        :param cache_size: number of availability patterns whose neighbor lists are kept
+        :param table: table the flags are appended to
+        :param time_step: length of the periods the readings are summed to before they are
+        checked (the 15 minutes of the 'fif' table by default)
+        """
+        self.network = network or get_gauge_network()
+        self.outlier_check = outlier_check
+        self.latency_budget = latency_budget
+        self.cache_size = cache_size
+        self.table = table
+        self.time_step = time_step
+        n = len(self.network)
+        self.use = ~self.network.src_mask('wu') if outlier_check else np.ones(n, dtype=bool)
+        self._neighbors = OrderedDict()
+        self.value_stats = RunningStats(n)
+        self.diff_stats = RunningStats(n)
+        self.n_poss = np.zeros(n, dtype=int)
+        self.n_out = np.zeros(n, dtype=int)
+        self.overruns = 0
+        self.last_latency = 0.
+
+    def neighbors(self, avail):
+        """
+        neighbor lists and distances of the reporting stations for one availability pattern,
+        computed once and kept in an LRU cache
+        """
+        key = avail.tobytes()
+        if key in self._neighbors:
+            self._neighbors[key] = entry = self._neighbors.pop(key)
+            return entry
+        sta = np.flatnonzero(avail)
+        cand = np.flatnonzero(avail & self.use)
+        if len(sta) == 0 or len(cand) == 0:
+            entry = None
+        else:
+            neigh, neigh_d, mask, num_neighs = neighbor_lists(self.network.distances, sta, cand)
+            n_d = mask.sum(axis=1)
+            padded = np.column_stack([neigh_d, np.full(len(sta), np.nan)])
+            rows = np.arange(len(sta))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ave_distance = np.where(mask, neigh_d, 0.).sum(axis=1) / n_d
+            entry = {'sta': sta, 'cand': cand, 'neigh': neigh, 'neigh_d': neigh_d, 'mask': mask,
+                     'num_neighbors': num_neighs,
+                     'shortest_dist': padded[rows, np.where(n_d > 0, 0, neigh_d.shape[1])],
+                     'longest_dist': padded[rows, np.where(n_d > 0, n_d - 1, neigh_d.shape[1])],
+                     'ave_distance': ave_distance,
+                     'neighbors': [str(self.network.site_names[neigh[r][mask[r]]].tolist())
+                                   for r in rows]}
+        self._neighbors[key] = entry
+        if len(self._neighbors) > self.cache_size:
+            self._neighbors.popitem(last=False)
+        return entry
+
+    def warm_up(self):
+        # neighbor lists of the full network and of every single gauge missing
+        full = np.ones(len(self.network), dtype=bool)
+        self.neighbors(full)
+        for i in range(len(full)):
+            avail = full.copy()
+            avail[i] = False
+            self.neighbors(avail)
+
+    def check(self, time_stamp, values):
+        """
+        check one time step and update the running statistics
+        :param time_stamp: time stamp written to the flags
+        :param values: (n,) values in network order, NaN for gauges that did not report
+        :return: data frame of the flagged values (same columns as 'qc_results')
+        """
+        start = time.time()
+        values = np.asarray(values, dtype=float)
+        self.value_stats.update(values)
+        entry = self.neighbors(np.isfinite(values))
+        if entry is None:
+            return pd.DataFrame(columns=flag_columns)
+        sta = entry['sta']
+        pred, std = idw(values[entry['neigh']][:, :, np.newaxis], entry['neigh_d'],
+                        entry['mask'])
+        pred, std = pred[:, 0], std[:, 0]
+        samp_prcp = values[sta]
+        neigh_diff = abs(pred - samp_prcp)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.outlier_check:
+                percent_diff = neigh_diff * 2 / (samp_prcp + pred)
+            else:
+                percent_diff = neigh_diff / samp_prcp
+            out = np.where(neigh_diff > std * 3, 'a', 'NA')
+            out = np.where((samp_prcp == 0) & (pred > 10), 'b', out)
+            index = percent_diff / entry['ave_distance']
+
+        diff = np.full(len(values), np.nan)
+        diff[sta] = pred - samp_prcp
+        self.diff_stats.update(diff)
+        self.n_poss[sta] += 1
+        flagged = out != 'NA'
+        self.n_out[sta[flagged]] += 1
+
+        f = np.flatnonzero(flagged)
+        flags = pd.DataFrame({'datetime': [str(time_stamp)] * len(f),
+                              'true_station': self.network.site_names[sta[f]],
+                              'recorded_val': samp_prcp[f],
+                              'neighbors': [entry['neighbors'][i] for i in f],
+                              'num_neighbors': entry['num_neighbors'][f],
+                              'shortest_dist': entry['shortest_dist'][f],
+                              'longest_dist': entry['longest_dist'][f],
+                              'ave_distance': entry['ave_distance'][f],
+                              'pred_val': pred[f],
+                              'global_mean': np.full(len(f), values[entry['cand']].mean()),
+                              'percent_diff': percent_diff[f],
+                              'index': index[f],
+                              'src': self.network.src[sta[f]],
+                              'out': out[f]},
+                             columns=flag_columns)
+        self.last_latency = time.time() - start
+        if self.last_latency > self.latency_budget:
+            self.overruns += 1
+            print 'qc of {} took {:.3f} s (budget {:.3f} s)'.format(time_stamp, self.last_latency,
+                                                                    self.latency_budget)
+        return flags
+
+    def append_flags(self, flags):
+        # append to the flag table without touching the rows already in it
+        if len(flags):
+            con = get_db_connection()
+            flags.to_sql(self.table, con, if_exists='append', index=False)
+            con.commit()
+            clear_table_cache()
+
+    def process(self, obs):
+        """
+        check newly arrived observations and append their flags to the database. the readings
+        (at any time stamps) are summed per site into time_step periods labeled by their start,
+        and the periods are checked in order. a period should arrive complete: readings of one
+        period that are split over two calls are checked as two separate steps
+        :param obs: data frame of observations with 'site_name', 'datetime' and 'precip_mm'
+        columns (like 'all_data'); sites that are not in the network are ignored
+        :return: data frame of the flagged values
+        """
+        ids = pd.Series(self.network.site_ids, index=self.network.site_names)
+        obs = obs[obs['site_name'].isin(ids.index)]
+        obs = obs.set_index(pd.DatetimeIndex(pd.to_datetime(obs['datetime'])))
+        obs = obs.assign(precip_mm=obs['precip_mm'].astype(float))
+        totals = aggregate_long(obs, self.time_step)
+        all_flags = []
+        for time_stamp, step in totals.groupby(level='datetime', sort=True):
+            values = np.full(len(self.network), np.nan)
+            values[ids[step.index.get_level_values('site_name')].values] = step.values
+            flags = self.check(time_stamp, values)
+            self.append_flags(flags)
+            all_flags.append(flags)
+        if not all_flags:
+            return pd.DataFrame(columns=flag_columns)
+        return pd.concat(all_flags, ignore_index=True)
+
+    def summary(self):
+        """
+        :return: per station running counts of checked and flagged values and running mean and
+        standard deviation of the values and of the prediction errors
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            percent_out = self.n_out / self.n_poss.astype(float)
+        seen = self.value_stats.count > 0
+        checked = self.diff_stats.count > 0
+        return pd.DataFrame({'station': self.network.site_names,
+                             'src': self.network.src,
+                             'n_poss': self.n_poss,
+                             'n_out': self.n_out,
+                             'percent_out': percent_out,
+                             'mean_val': np.where(seen, self.value_stats.mean, np.nan),
+                             'std_val': self.value_stats.std,
+                             'mean_diff': np.where(checked, self.diff_stats.mean, np.nan),
+                             'std_diff': self.diff_stats.std},
+                            columns=['station', 'src', 'n_poss', 'n_out', 'percent_out',
+                                     'mean_val', 'std_val', 'mean_diff', 'std_diff'])
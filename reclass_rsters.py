@@ -7,24 +7,12 @@ import arcpy
 from arcpy import env
 from arcpy.sa import *
 from storm_stats_functions import data_dir, check_dir
+from accumulate_storm_totals import closest_to_hour
 import os
 import numpy as np
 from datetime import datetime
 
 
-def find_nearest(array, value):
-    idx = (np.abs(array-value)).argmin()
-    return idx
-
-
-def closest_to_hour(f_names):
-    no_extension = [f.replace('.tif', '') for f in f_names]
-    f_hours = np.array([f.split('_')[-1] for f in no_extension])
-    f_hours = f_hours.astype(int)
-    check_hours = np.arange(0, 240000, step=10000)
-    return [f_names[find_nearest(f_hours, hr)] for hr in check_hours]
-
-
 # Set environment settings
 rain_date = "20151002"
 data_dir = "{}/nexrad/{}".format(data_dir, rain_date)
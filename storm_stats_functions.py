@@ -4,6 +4,7 @@
 
 import numpy as np
 import pandas as pd
+from pandas.tseries.frequencies import to_offset
 import datetime
 import matplotlib.pyplot as plt
 import math
@@ -12,11 +13,24 @@ import matplotlib.animation as animation
 from descartes import PolygonPatch
 import shapefile
 import sqlite3
+import weakref
+from collections import OrderedDict
 
 basedir = os.path.dirname(__file__)
 data_dir = os.path.join(basedir, '../Data/')
 db_filename = os.path.join(data_dir, 'master.sqlite')
 
+# shared database connections and the LRU cache of query results (see get_data_frame_from_table)
+_connections = {}
+_table_cache = OrderedDict()
+table_cache_size = 16
+
+# durations of the maximum intensity engine (see get_max_intensities)
+max_intensity_durations = ["5T", "15T", "30T", "H", "2H", "6H", "12H", "24H"]
+
+# memoized storm durations (see get_storm_durations)
+_duration_cache = {}
+
 # plt.rcParams['animation.ffmpeg_path'] = 'C:/Users/jeff_dsktp/Downloads/ffmpeg-20160301-git-1c7e2cf-win64-static/ffmpeg-20160301-git-1c7e2cf-win64-static/bin/ffmpeg'
 
 ####################################################################################################
@@ -24,46 +38,129 @@ db_filename = os.path.join(data_dir, 'master.sqlite')
 ####################################################################################################
 
 
-def get_data_frame_from_table(table_name):
-    print 'fetching data from database for {}'.format(table_name)
-    # set up db connection
-    global basedir
+def get_db_connection(db=None):
+    # reuse one connection per database file and process
+    db = db or db_filename
+    key = (db, os.getpid())
+    con = _connections.get(key)
+    if con is None:
+        con = sqlite3.connect(db)
+        _connections[key] = con
+    return con
 
-    # connect to db
-    con = sqlite3.connect(db_filename)
 
-    # run a query and get the results
-    sql = 'SELECT * FROM {};'.format(table_name)  # your query goes here
-    df = pd.read_sql(sql, con)
-    con.close()
-    return df
+def get_db_version(db=None):
+    return os.path.getmtime(db or db_filename)
 
 
-def make_incremental(df, date_range):
-    newdf = pd.DataFrame()
-    non_cumulative_df = pd.DataFrame()
-    for date in date_range:
-        print "making incremental for {}".format(date)
-        df_date = df[date]
-        df_date = df_date.groupby(['x', 'y'])
-        for location in df_date:
-            xy_df = location[1]
-            cum_precip_arr = np.array(xy_df['precip_mm'])
-            incr_precip = [0]
-            for i in range(len(cum_precip_arr)-1):
-                if cum_precip_arr[i+1] >= cum_precip_arr[i] > 0:
-                    incr_precip.append(cum_precip_arr[i+1] - cum_precip_arr[i])
-                else:
-                    non_cumulative_df = non_cumulative_df.append(location[1].iloc[[i]])
-                    incr_precip.append(0)
-            xy_df.loc[:, 'precip_mm'] = incr_precip
-            newdf = newdf.append(xy_df)
+def clear_table_cache():
+    _table_cache.clear()
+
+
+def build_table_query(table_name, columns=None, dates=None, start=None, end=None, src=None,
+                      time_col='datetime'):
+    """
+    build a parametrized SELECT with the projection and filters pushed into sql
+    :param table_name: table to read
+    :param columns: list of columns to return (all columns if None)
+    :param dates: list of calendar dates ('YYYY-MM-DD'); only rows on these days are returned
+    :param start: only return rows with time_col >= start
+    :param end: only return rows with time_col < end
+    :param src: a source name or list of source names to keep
+    :param time_col: column holding the ISO formatted ('YYYY-MM-DD HH:MM:SS') timestamps
+    :return: sql string and list of parameters
+    """
+    cols = '*' if columns is None else ', '.join('"{}"'.format(c) for c in columns)
+    sql = 'SELECT {} FROM {}'.format(cols, table_name)
+    conditions = []
+    params = []
+    if dates is not None:
+        day_conditions = []
+        for d in pd.to_datetime(sorted(set(dates))):
+            day_conditions.append('("{0}" >= ? AND "{0}" < ?)'.format(time_col))
+            params.extend([d.strftime('%Y-%m-%d'),
+                           (d + pd.Timedelta(days=1)).strftime('%Y-%m-%d')])
+        conditions.append('({})'.format(' OR '.join(day_conditions) or '0'))
+    if start is not None:
+        conditions.append('"{}" >= ?'.format(time_col))
+        params.append(pd.Timestamp(start).strftime('%Y-%m-%d %H:%M:%S'))
+    if end is not None:
+        conditions.append('"{}" < ?'.format(time_col))
+        params.append(pd.Timestamp(end).strftime('%Y-%m-%d %H:%M:%S'))
+    if src is not None:
+        srcs = [src] if isinstance(src, basestring) else list(src)
+        conditions.append('src IN ({})'.format(', '.join('?' * len(srcs))))
+        params.extend(srcs)
+    if conditions:
+        sql += ' WHERE {}'.format(' AND '.join(conditions))
+    return sql + ';', params
+
+
+def get_data_frame_from_table(table_name, columns=None, dates=None, start=None, end=None,
+                              src=None, time_col='datetime', use_cache=True):
+    """
+    read a table through a shared connection and an in-process LRU cache. the cache is keyed on
+    the query and invalidated when the database file changes. see build_table_query for the
+    filter parameters
+    :return: data frame (a copy, so callers may modify it)
+    """
+    sql, params = build_table_query(table_name, columns, dates, start, end, src, time_col)
+    key = (db_filename, sql, tuple(params))
+    version = get_db_version()
+    if use_cache and key in _table_cache:
+        cached_version, df = _table_cache.pop(key)
+        if cached_version == version:
+            _table_cache[key] = (cached_version, df)
+            return df.copy()
+
+    print 'fetching data from database for {}'.format(table_name)
+    df = pd.read_sql(sql, get_db_connection(), params=params)
+    if use_cache:
+        _table_cache[key] = (version, df)
+        while len(_table_cache) > table_cache_size:
+            _table_cache.popitem(last=False)
+    return df.copy()
+
+
+def make_incremental(df, date_range, report_file="non_cumulative.csv"):
+    """
+    convert cumulative gauge readings to incremental depths for all sites and dates in one
+    grouped pass
+    :param df: data frame with a datetime index and at least 'x', 'y' and 'precip_mm' columns
+    :param date_range: list of dates ('YYYY-MM-DD') to convert
+    :param report_file: csv that the non-cumulative readings are appended to
+    :return: data frame with incremental 'precip_mm' (datetime as a column)
+    """
+    days = df.index.normalize()
+    df = df[days.isin(pd.to_datetime(date_range))]
+    if df.empty:
+        return df.reset_index(inplace=False)
+    df = df.assign(_day=df.index.normalize(), _order=np.arange(len(df)))
+    df = df.sort_values(['_day', 'x', 'y', '_order'], kind='mergesort')
+
+    # an increment is only valid if the reading before it was positive and it did not reset
+    gp = df.groupby(['_day', 'x', 'y'], sort=False)['precip_mm']
+    cum_precip = df['precip_mm'].values
+    prev_precip = gp.shift(1).values
+    next_precip = gp.shift(-1).values
+    position = gp.cumcount().values
+    is_last = (position == gp.transform('size').values - 1)
+    with np.errstate(invalid='ignore'):
+        valid_incr = (cum_precip >= prev_precip) & (prev_precip > 0)
+        valid_next = (next_precip >= cum_precip) & (cum_precip > 0)
+    incr_precip = np.where(valid_incr, cum_precip - prev_precip, 0.)
+
+    # a reading is non-cumulative if the step from it to the next one was invalid
+    non_cumulative_df = df[~is_last & ~valid_next].drop(['_day', '_order'], axis=1)
+    non_cumulative_df.to_csv(report_file, mode='a')
+
+    newdf = df.drop(['_day', '_order'], axis=1)
+    newdf['precip_mm'] = incr_precip
     newdf = newdf.reset_index(inplace=False)
-    non_cumulative_df.to_csv("{}.csv".format("non_cumulative"), mode='a')
     return newdf
 
 
-def combine_data_frames(exclude_zeros=True):
+def combine_data_frames(exclude_zeros=True, dates=None, use_cache=False):
     hrsd_stations_in_study_area = ["MMPS-171",
                                    "MMPS-185",
                                    "MMPS-163",
@@ -77,11 +174,19 @@ def combine_data_frames(exclude_zeros=True):
                                    "MMPS-036",
                                    "MMPS-093-2"]
 
-    # prepare the data by pulling from the database and making the datetime the index
-    df = get_data_frame_from_table('all_data')
-    df['datetime'] = pd.to_datetime(df['datetime'])
+    # prepare the data by pulling the storm windows from the database and making the datetime the
+    # index
+    if dates is None:
+        dates = get_date_range()
+    if use_cache:
+        # memory-mapped columnar copy of all_data (see obs_cache.py)
+        from obs_cache import load_all_data
+        df = load_all_data(dates)
+    else:
+        df = get_data_frame_from_table('all_data', dates=dates)
+        df['datetime'] = pd.to_datetime(df['datetime'])
     if exclude_zeros:
-        df = zero_sum_days_to_nan(df)
+        df, zero_days = zero_sum_days_to_nan(df, dates)
     df = df.set_index('datetime')
 
     return df
@@ -450,58 +555,193 @@ def get_daily_aggregate(df, date, time_step):
     return df_agg
 
 
-def get_daily_tots_df(exclude_zeros=True, qc=True):
+def aggregate_long(df, time_step):
+    """
+    sum the readings of every site into time_step buckets (labeled by their left edge, like
+    resample)
+    :param df: data frame with a datetime index and 'site_name' and 'precip_mm' columns
+    :return: series of totals indexed by (site_name, datetime); buckets with only NaN readings
+    (e.g. site-days masked by zero_sum_days_to_nan) are 0, like the resample sums
+    """
+    buckets = df.index.floor(time_step)
+    agg = df['precip_mm'].groupby([df['site_name'], buckets]).sum()
+    agg.index.names = ['site_name', 'datetime']
+    return agg
+
+
+def coarsen_long(agg, time_step):
+    # derive a coarser aggregate by summing the buckets of a finer one (NaN buckets count as 0,
+    # like summing the readings with resample)
+    buckets = agg.index.get_level_values('datetime').floor(time_step)
+    coarse = agg.groupby([agg.index.get_level_values('site_name'), buckets]).sum()
+    coarse.index.names = ['site_name', 'datetime']
+    return coarse
+
+
+def storm_time_range(dur_df, date, time_step):
+    s = dur_df["start_time"][date]
+    e = dur_df["end_time"][date]
+    if time_step == "H":
+        s = s - pd.Timedelta(minutes=s.minute)
+    return pd.date_range(s, e, freq=time_step)
+
+
+def storm_matrix(agg, time_range, site_names):
+    """
+    build the site x time step matrix of a storm with one unstack onto the storm time range
+    :param agg: series of totals indexed by (site_name, datetime)
+    :param time_range: DatetimeIndex of the storm time steps (all on one calendar day)
+    :param site_names: sites (rows) of the matrix
+    :return: float array of shape (len(site_names), len(time_range))
+    """
+    day = time_range[0].normalize()
+    times = agg.index.get_level_values('datetime')
+    day_agg = agg[(times >= day) & (times < day + pd.Timedelta(days=1))]
+    wide = day_agg.unstack('datetime').reindex(index=site_names, columns=time_range)
+
+    # like resample, steps without readings between a site's first and last reading of the day are 0
+    present = pd.Series(1., index=day_agg.index).unstack('datetime')
+    present = present.reindex(index=site_names, columns=time_range).notnull().values
+    day_times = pd.Series(day_agg.index.get_level_values('datetime'),
+                          index=day_agg.index.get_level_values('site_name'))
+    span = day_times.groupby(level=0).agg(['min', 'max']).reindex(site_names)
+    steps = time_range.values[np.newaxis, :]
+    in_span = (steps >= span['min'].values[:, np.newaxis]) & \
+              (steps <= span['max'].values[:, np.newaxis])
+    values = wide.values
+    values[in_span & ~present] = 0.
+    return values
+
+
+def storm_wide_df(agg, time_range, summary_df):
+    """
+    lay the aggregate out as one column per time step of the storm
+    :param agg: series of totals indexed by (site_name, datetime)
+    :param time_range: DatetimeIndex of the storm time steps (all on one calendar day)
+    :param summary_df: data frame of the sites (see get_empty_summary_df)
+    :return: summary_df with one column ('YYYY-MM-DD HH:MM:SS') per time step added
+    """
+    values = storm_matrix(agg, time_range, summary_df.index)
+    wide = pd.DataFrame(values, index=summary_df.index,
+                        columns=time_range.strftime('%Y-%m-%d %H:%M:%S'))
+    return pd.concat([summary_df, wide], axis=1)
+
+
+def get_multi_resolution_dfs(exclude_zeros=True):
+    """
+    build the 'fif', 'hr' and 'daily' summary tables from one load of the data. the data are
+    aggregated to 15 minutes once and the hourly and daily totals are summed from that
+    :return: dictionary of table name -> data frame (as update_db would write them)
+    """
+    date_range = get_date_range()
+    df = combine_data_frames(exclude_zeros)
+    summary_df = get_empty_summary_df()
+    dur_df = get_storm_durations(df, date_range, 0.025)
+
+    aggs = {'fif': aggregate_long(df, '15T')}
+    aggs['hr'] = coarsen_long(aggs['fif'], 'H')
+    aggs['daily'] = coarsen_long(aggs['hr'], 'D')
+
+    daily = aggs['daily'].unstack('datetime')
+    daily.columns = daily.columns.strftime('%Y-%m-%d')
+    tables = {'daily': qc_wu(summary_df.join(daily.reindex(columns=date_range)))}
+    for table_name, time_step in [('fif', '15T'), ('hr', 'H')]:
+        l = []
+        for date in date_range:
+            time_range = storm_time_range(dur_df, date, time_step)
+            l.append((date, storm_wide_df(aggs[table_name], time_range, summary_df)))
+        tables[table_name] = combine_sub_daily_dfs(l)
+    return tables
+
+
+def get_daily_tots_df(exclude_zeros=True, qc=True, chunksize=None):
+        """
+        :param exclude_zeros: leave out the readings of site-days that sum to zero (see
+        zero_sum_days_to_nan). the totals of those site-days are 0 in both modes
+        :param qc: remove the known bad WU sites
+        :param chunksize: if given, stream all_data in chunks of this many rows (see
+        stream_aggregate) so memory is set by the chunk size rather than the whole table
+        :return: summary data frame with one column of daily totals per storm date
+        """
         summary_df = get_empty_summary_df()
-        df = combine_data_frames(exclude_zeros=exclude_zeros)
-        for date in get_date_range():
-            daily_tot = get_daily_aggregate(df, date, "D")
-            daily_tot = daily_tot.sum(level="site_name")
-
-            # add to summary dataframe
-            daily_tot.rename(columns={'precip_mm': date}, inplace=True)
-            summary_df = summary_df.join(daily_tot[date])
+        if chunksize:
+            dates = get_date_range()
+            daily_tots = stream_aggregate("D", dates, exclude_zeros, chunksize).unstack()
+            daily_tots.columns = daily_tots.columns.strftime('%Y-%m-%d')
+            summary_df = summary_df.join(daily_tots.reindex(columns=dates))
+        else:
+            df = combine_data_frames(exclude_zeros=exclude_zeros)
+            for date in get_date_range():
+                daily_tot = get_daily_aggregate(df, date, "D")
+                daily_tot = daily_tot.sum(level="site_name")
+
+                # add to summary dataframe
+                daily_tot.rename(columns={'precip_mm': date}, inplace=True)
+                summary_df = summary_df.join(daily_tot[date])
         if qc:
             return qc_wu(summary_df)
         else:
             return summary_df
 
 
-def get_subdaily_df(time_step, exclude_zeros=True):
+def stream_aggregate(time_step, dates=None, exclude_zeros=True, chunksize=100000):
+    """
+    sum the observations of every site into time_step buckets while reading all_data in chunks.
+    only the running (site, bucket) and (site, day) totals are kept between chunks
+    :param time_step: pandas offset alias of the buckets, e.g. "D", "H" or "15T"
+    :param dates: dates to aggregate; defaults to get_date_range()
+    :param exclude_zeros: leave out the readings of site-days that sum to zero, like
+    combine_data_frames(exclude_zeros=True); their buckets are 0 like in the non-streaming sums
+    :param chunksize: number of rows read at a time
+    :return: series of totals indexed by (site_name, datetime)
+    """
+    if dates is None:
+        dates = get_date_range()
+    sql, params = build_table_query('all_data', columns=['site_name', 'datetime', 'precip_mm'],
+                                    dates=dates)
+    bucket_tots = pd.Series()
+    day_tots = pd.Series()
+    for chunk in pd.read_sql(sql, get_db_connection(), params=params, chunksize=chunksize):
+        times = pd.to_datetime(chunk['datetime'])
+        precip = chunk['precip_mm'].astype(float)
+        part = precip.groupby([chunk['site_name'], times.dt.floor(time_step)]).sum()
+        bucket_tots = part if bucket_tots.empty else bucket_tots.add(part, fill_value=0)
+        if exclude_zeros:
+            part = precip.groupby([chunk['site_name'], times.dt.normalize()]).sum()
+            day_tots = part if day_tots.empty else day_tots.add(part, fill_value=0)
+    bucket_tots.index.names = ['site_name', 'datetime']
+
+    if exclude_zeros and not bucket_tots.empty:
+        zero_days = day_tots[day_tots == 0].index
+        sites = bucket_tots.index.get_level_values('site_name')
+        days = bucket_tots.index.get_level_values('datetime').normalize()
+        zero_mask = pd.MultiIndex.from_arrays([sites, days]).isin(zero_days)
+        bucket_tots[zero_mask] = 0.
+    return bucket_tots
+
+
+def get_subdaily_df(time_step, exclude_zeros=True, as_matrix=False):
+    """
+    :param time_step: "15T" or "H"
+    :param exclude_zeros: set the readings of site-days that sum to zero to NaN
+    :param as_matrix: return (date, values, site_names, times) tuples with the site x time step
+    array of each storm instead of (date, data frame) tuples
+    :return: list with one tuple per storm date
+    """
     date_range = get_date_range()
     df = combine_data_frames(exclude_zeros)
     dur_df = get_storm_durations(df, date_range, 0.025)
     summary_df = get_empty_summary_df()
+    agg = aggregate_long(df, time_step)
     l = []
     for date in date_range:
-        sdf = summary_df
         print "getting subdaily values for {}".format(date)
-        df_date = df[date]
-
-        # get duration
-        e = dur_df["end_time"][date]
-        s = dur_df["start_time"][date]
-        if time_step == "H":
-            s = s - pd.Timedelta(minutes=s.minute)
-        time_range = pd.date_range(s, e, freq=time_step)
-        time_range_formatted = []
-        for t in time_range:
-            time_range_formatted.append(t._repr_base)
-
-        # aggregate
-        df_gp = df_date.groupby(['x', 'y', 'site_name', 'src'])
-        df_agg = df_gp.resample(time_step).agg({'precip_mm': np.sum})
-        df_agg = df_agg.reset_index()
-        df_agg = df_agg.set_index("datetime")
-
-        # sum for each time step in duration
-        for time in time_range_formatted:
-            t = get_daily_aggregate(df_agg, time, time_step)
-            t = t.sum(level="site_name")
-
-            # add to summary dataframe
-            t.rename(columns={'precip_mm': time}, inplace=True)
-            sdf = sdf.join(t[time])
-        l.append((date, sdf))
+        time_range = storm_time_range(dur_df, date, time_step)
+        if as_matrix:
+            values = storm_matrix(agg, time_range, summary_df.index)
+            l.append((date, values, summary_df.index.values, time_range.values))
+        else:
+            l.append((date, storm_wide_df(agg, time_range, summary_df)))
     return l
 
 
@@ -519,60 +759,155 @@ def combine_sub_daily_dfs(df_list):
 
 
 def get_storm_durations(df, date_range, trim_percent):
-    i = 0
-    for date in date_range:
-        df_agg = get_daily_aggregate(df, date, "15T")
-        time_sums = df_agg.sum(level="datetime")
-        cum_percent = time_sums.cumsum()/time_sums.sum()
-        trimmed_indices = \
-            cum_percent[(cum_percent['precip_mm'] > trim_percent) &
-                        (cum_percent['precip_mm'] < (1-trim_percent))].index
-        start_time = trimmed_indices.min()
-        end_time = trimmed_indices.max()
-        duration = (end_time-start_time).total_seconds()/3600
-        if i == 0:
-            dur_df = pd.DataFrame({'start_time': [start_time], 'end_time':[end_time],
-                                   'date': [date], 'duration (hr)': [duration]})
-        else:
-            dur_df = dur_df.append({'start_time': start_time, 'end_time':end_time, 'date': date,
-                                    'duration (hr)': duration}, ignore_index=True)
-        i=1
+    """
+    find the start and end of every storm as the 15 minute steps where the cumulative fraction of
+    the network rainfall of the day lies between trim_percent and 1 - trim_percent. all dates
+    are done at once on a (date x 15 minute step) array and the result is memoized per data set
+    and trim_percent
+    :param df: data frame with a datetime index and a 'precip_mm' column
+    :param date_range: list of dates ('YYYY-MM-DD')
+    :param trim_percent: fraction of rainfall trimmed from each end of the storm
+    :return: data frame indexed by date with 'duration (hr)', 'end_time' and 'start_time' columns
+    """
+    key = (id(df), tuple(date_range), trim_percent)
+    version = (get_db_version() if os.path.exists(db_filename) else None, len(df))
+    cached = _duration_cache.get(key)
+    if cached and cached[0]() is df and cached[1] == version:
+        return cached[2].copy()
+
+    # network total for every 15 minute step of every date
+    days = pd.to_datetime(date_range)
+    steps_per_day = 96
+    in_days = df.index.normalize().isin(days)
+    time_sums = df['precip_mm'][in_days].groupby(df.index[in_days].floor("15T")).sum()
+    steps = days.values[:, np.newaxis] + \
+        np.arange(steps_per_day) * np.timedelta64(15, 'm')
+    time_sums = time_sums.reindex(steps.ravel()).fillna(0).values.reshape(steps.shape)
+
+    # searchsorted on the (non-decreasing) cumulative fractions of each date
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cum_percent = time_sums.cumsum(axis=1) / time_sums.sum(axis=1)[:, np.newaxis]
+        start_idx = (cum_percent <= trim_percent).sum(axis=1)
+        end_idx = (cum_percent < (1 - trim_percent)).sum(axis=1) - 1
+    has_storm = start_idx <= end_idx
+    rows = np.arange(len(days))
+    start_time = np.where(has_storm, steps[rows, np.minimum(start_idx, steps_per_day - 1)],
+                          np.datetime64('NaT'))
+    end_time = np.where(has_storm, steps[rows, np.maximum(end_idx, 0)], np.datetime64('NaT'))
+    dur_df = pd.DataFrame({'date': list(date_range),
+                           'duration (hr)': (end_time - start_time) / np.timedelta64(1, 'h'),
+                           'end_time': pd.to_datetime(end_time),
+                           'start_time': pd.to_datetime(start_time)},
+                          columns=['date', 'duration (hr)', 'end_time', 'start_time'])
     dur_df = dur_df.set_index("date")
-    return dur_df
+
+    _duration_cache[key] = (weakref.ref(df), version, dur_df)
+    return dur_df.copy()
+
+
+def get_max_intensities(df, date_range, durations=max_intensity_durations, base_step="5T"):
+    """
+    maximum accumulated depth of every site and date for several durations. the readings are
+    summed onto a (site-day x base_step) array once and the depth of every moving window of a
+    duration is the difference of two cumulative sums, so each duration costs one pass
+    :param df: data frame with a datetime index and 'site_name' and 'precip_mm' columns
+    :param date_range: list of dates ('YYYY-MM-DD')
+    :param durations: pandas offset aliases of the durations; must be multiples of base_step
+    :param base_step: resolution the readings are summed to
+    :return: tidy data frame with 'site_name', 'date', 'duration', 'max_depth' (mm) and
+    'time_of_max' (start of the wettest window) columns, one row per site-day with readings
+    (site-days whose readings are all NaN have a max_depth of 0, like the resample sums)
+    """
+    days = pd.to_datetime(date_range)
+    df = df[df.index.normalize().isin(days)]
+    agg = aggregate_long(df, base_step)
+    base = pd.Timedelta(to_offset(base_step).nanos)
+    steps_per_day = int(pd.Timedelta(days=1) / base)
+
+    # one row per site-day, one column per base step
+    times = agg.index.get_level_values('datetime')
+    keys = pd.DataFrame({'site_name': agg.index.get_level_values('site_name'),
+                         'date': times.normalize()})
+    row_gp = keys.groupby(['site_name', 'date'])
+    rows = row_gp.ngroup().values
+    row_keys = row_gp.size().index
+    cols = ((times - times.normalize()) / base).astype(int)
+    values = np.zeros((len(row_keys), steps_per_day))
+    values[rows, cols] = agg.values
+
+    cum = np.zeros((len(row_keys), steps_per_day + 1))
+    cum[:, 1:] = values.cumsum(axis=1)
+    row_days = row_keys.get_level_values('date').values
+    l = []
+    for duration in durations:
+        k = int(pd.Timedelta(to_offset(duration).nanos) / base)
+        if k < 1 or k > steps_per_day:
+            raise ValueError('duration {} does not fit base step {} within a day'.format(
+                duration, base_step))
+        window_sums = cum[:, k:] - cum[:, :-k]
+        max_idx = window_sums.argmax(axis=1)
+        max_depth = window_sums[np.arange(len(row_keys)), max_idx]
+        l.append(pd.DataFrame({'site_name': row_keys.get_level_values('site_name'),
+                               'date': pd.to_datetime(row_days).strftime('%Y-%m-%d'),
+                               'duration': duration,
+                               'max_depth': max_depth,
+                               'time_of_max': row_days + max_idx * base.to_timedelta64()},
+                              columns=['site_name', 'date', 'duration', 'max_depth',
+                                       'time_of_max']))
+    return pd.concat(l, ignore_index=True)
 
 
 def get_daily_max_intensities(df, date_range, time_step):
+    """
+    :param time_step: "15T" for the wettest 15 minutes or "H" for the wettest hour (a moving
+    window of four 15 minute steps)
+    :return: summary data frame with one column of maximum depths per date
+    """
     summary_df = get_empty_summary_df()
-    for date in date_range:
-        df_agg = get_daily_aggregate(df, date, "15T")
-        if time_step == 'H':
-            df_agg = pd.rolling_sum(df_agg, 4).max(level='site_name')
-        else:
-            df_agg = df_agg.max(level="site_name")
-
-        # add to summary dataframe
-        df_agg.rename(columns={'precip_mm': date}, inplace=True)
-        summary_df = summary_df.join(df_agg[date])
+    max_int = get_max_intensities(df, date_range, [time_step], base_step="15T")
+    max_int = max_int.pivot(index='site_name', columns='date', values='max_depth')
+    summary_df = summary_df.join(max_int.reindex(columns=date_range))
     return summary_df
 
 
-def zero_sum_days_to_nan(raw_df):
-    dates = get_date_range()
-    for site in raw_df.site_name.unique():
-        df1 = raw_df[raw_df.site_name == site]
-        df1.set_index('datetime', inplace=True)
-        for date in dates:
-            try:
-                if df1[date].precip_mm.sum() == 0 and not df1[date].empty:
-                    print site, ",", date
-                    raw_df.loc[df1[date]['index'], 'precip_mm'] = np.nan
-            except KeyError:
-                continue
-    return raw_df
+def zero_sum_days_to_nan(raw_df, dates=None):
+    """
+    set the readings of every site-day that sums to zero to NaN
+    :param raw_df: data frame with 'site_name', 'datetime' and 'precip_mm' columns
+    :param dates: dates to check; defaults to get_date_range()
+    :return: the masked data frame and a data frame of the masked site-days ('site_name', 'date')
+    """
+    if dates is None:
+        dates = get_date_range()
+    days = raw_df['datetime'].dt.normalize()
+    in_dates = days.isin(pd.to_datetime(dates))
+
+    # sum each (site, calendar day) and broadcast it back to the readings
+    day_sums = raw_df['precip_mm'][in_dates].groupby([raw_df['site_name'][in_dates],
+                                                      days[in_dates]]).transform('sum')
+    zero_mask = (day_sums == 0).reindex(raw_df.index, fill_value=False)
+    raw_df.loc[zero_mask, 'precip_mm'] = np.nan
+
+    masked_days = pd.DataFrame({'site_name': raw_df['site_name'][zero_mask],
+                                'date': days[zero_mask].dt.strftime('%Y-%m-%d')})
+    masked_days = masked_days.drop_duplicates().sort_values(['date', 'site_name'])
+    masked_days = masked_days.reset_index(drop=True)[['site_name', 'date']]
+    return raw_df, masked_days
 
 
-def create_summary_table(summ_df, mdih, mdif, dty, file_name):
-    dur_df = get_storm_durations(summ_df, get_date_range(), 0.025)
+def create_summary_table(summ_df, mdih, mdif, dty, file_name, obs_df=None, max_intensities=None):
+    """
+    write the overall storm summary (one row per date) to <dty><file_name>.csv
+    :param summ_df: daily totals by site (see get_daily_tots_df)
+    :param mdih: maximum hourly intensities by site (see get_daily_max_intensities)
+    :param mdif: maximum 15 minute intensities by site
+    :param obs_df: observations the storm durations are computed from (see combine_data_frames,
+    which is called if not given)
+    :param max_intensities: optional tidy table of get_max_intensities(obs_df, ...)
+    """
+    if obs_df is None:
+        obs_df = combine_data_frames()
+    dur_df = get_storm_durations(obs_df, get_date_range(), 0.025)
     overall_summary_df_by_date = dur_df.join(pd.DataFrame(
         {'mean_total_rainfall_volume (mm)': summ_df.mean()})
     )
@@ -594,6 +929,13 @@ def create_summary_table(summ_df, mdih, mdif, dty, file_name):
     overall_summary_df_by_date = overall_summary_df_by_date.join(pd.DataFrame(
         {'max_max_15min_intensity (mm/15 min)': mdif.max()})
     )
+    if max_intensities is not None:
+        # mean and max over the sites of the maximum depths from get_max_intensities
+        gp = max_intensities.groupby(['date', 'duration'])['max_depth']
+        for stat in ['mean', 'max']:
+            depths = gp.agg(stat).unstack('duration')
+            depths.columns = ['{}_max_{}_depth (mm)'.format(stat, c) for c in depths.columns]
+            overall_summary_df_by_date = overall_summary_df_by_date.join(depths)
 
     # write to csv file ##
     overall_summary_df_by_date.to_csv("{}{}.csv".format(check_dir(dty), file_name))
@@ -608,18 +950,51 @@ def reformat_dates(dr):
 
 
 def update_table(table_name, df):
-    con = sqlite3.connect(db_filename)
+    con = get_db_connection()
     c = con.cursor()
-    c.execute('DROP TABLE {}'.format(table_name))
+    c.execute('DROP TABLE IF EXISTS {}'.format(table_name))
     df.to_sql(table_name, con)
+    clear_table_cache()
+
+
+def update_tables(tables):
+    """
+    replace several tables in one transaction. the data frames are first written to staging tables
+    that are then swapped in together
+    :param tables: dictionary of table name -> data frame
+    """
+    con = get_db_connection()
+    for table_name, df in tables.items():
+        df.reset_index().to_sql('{}_new'.format(table_name), con, if_exists='replace', index=False)
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        con.execute('BEGIN')
+        for table_name, df in tables.items():
+            con.execute('DROP TABLE IF EXISTS {}'.format(table_name))
+            con.execute('ALTER TABLE {0}_new RENAME TO {0}'.format(table_name))
+            con.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} ({1})'.format(
+                table_name, df.index.name))
+        con.execute('COMMIT')
+    except sqlite3.Error:
+        con.execute('ROLLBACK')
+        raise
+    finally:
+        con.isolation_level = isolation_level
+    clear_table_cache()
 
 
 def update_db(table_name):
     """
-    :param table_name: should be 'fif', 'daily' or 'hr'
+    :param table_name: should be 'fif', 'daily' or 'hr', or 'all' to refresh the three of them in
+    one pass over the data
     :return:
     """
-    if table_name == 'daily':
+    if table_name == 'all':
+        tables = get_multi_resolution_dfs()
+        update_tables(tables)
+        return tables
+    elif table_name == 'daily':
         df = get_daily_tots_df()
 
     else:
@@ -93,5 +93,6 @@ plot_sum_by_day(daily_tots_df, 'summary.png')
 #                      max_daily_intensities_hour,
 #                      max_daily_intensities_fifteen,
 #                      data_dir,
-#                      "overall_storm_summary")
+#                      "overall_storm_summary",
+#                      obs_df=combined_df)
 #
\ No newline at end of file
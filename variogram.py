@@ -0,0 +1,156 @@
+# Purpose: Experimental semivariograms and fitted variogram models of every time step of a wide
+# table, as a python replacement of R/rainfall_variograms.R. The gauge pair distances and lag
+# classes are computed once and shared by all time steps
+
+import multiprocessing
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import least_squares
+from storm_stats_functions import get_data_frame_from_table, update_table
+from kriging import semivariance
+from gauge_network import GaugeNetwork
+
+# lag and number of lags for variograms (same as the R script)
+lag = 1000.
+nlag = 20
+
+
+class LagBins:
+    def __init__(self, network, lag=lag, nlag=nlag):
+        """
+        gauge pairs and their lag classes. class k holds the pairs with distances in
+        [(k - 0.5) lag, (k + 0.5) lag), like vario.calc; pairs beyond the last class are dropped
+        :param network: GaugeNetwork of the gauges (rows of the value arrays)
+        """
+        i, j = np.triu_indices(len(network), k=1)
+        h = network.distances[i, j]
+        k = np.floor(h / lag + 0.5).astype(int)
+        keep = k < nlag
+        self.i, self.j, self.h, self.k = i[keep], j[keep], h[keep], k[keep]
+        self.lag = float(lag)
+        self.nlag = nlag
+        # (lag class x pair) indicator, so the class sums of all time steps are one product
+        self.indicator = sparse.csr_matrix((np.ones(len(self.k)), (self.k, np.arange(len(self.k)))),
+                                           shape=(nlag, len(self.k)))
+
+    def experimental(self, values):
+        """
+        experimental semivariograms of many time steps at once. pairs with a missing gauge are
+        left out of the time steps where it is missing
+        :param values: (n_gauges x t) array with NaN for missing gauges
+        :return: (nlag x t) arrays of the mean pair distance, semivariance and number of pairs of
+        every lag class (NaN where a class has no pairs)
+        """
+        values = np.asarray(values, dtype=float)
+        d = values[self.i] - values[self.j]
+        valid = np.isfinite(d)
+        sq = np.where(valid, d, 0.) ** 2
+        valid = valid.astype(float)
+        npairs = self.indicator.dot(valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gamma = 0.5 * self.indicator.dot(sq) / npairs
+            hbar = self.indicator.dot(valid * self.h[:, np.newaxis]) / npairs
+        return hbar, gamma, npairs
+
+
+def fit_model(hbar, gamma, npairs, model_type, x0=None, max_range=None):
+    """
+    weighted least squares fit of a variogram model without nugget to one experimental
+    variogram, the lag classes weighted by their number of pairs
+    :param x0: optional (sill, range) to start from, e.g. the fit of the previous time step
+    :param max_range: upper bound of the range (twice the largest lag distance by default)
+    :return: (sill, range, weighted sum of squares) or None if there is nothing to fit
+    """
+    ok = npairs > 0
+    if ok.sum() < 2:
+        return None
+    h, g, w = hbar[ok], gamma[ok], np.sqrt(npairs[ok] / npairs[ok].sum())
+    max_range = max_range or 2 * h.max()
+    if x0 is None:
+        x0 = (g.max(), h.max() / 2)
+    x0 = (max(x0[0], 1e-12), min(max(x0[1], 1.), max_range))
+
+    def residuals(p):
+        return w * (semivariance(h, model_type, p[1], p[0]) - g)
+
+    res = least_squares(residuals, x0, bounds=([0., 1.], [np.inf, max_range]))
+    return res.x[0], res.x[1], 2 * res.cost
+
+
+def fit_time_steps(args):
+    """
+    fit the time steps of one chunk in order, each fit starting from the one before it
+    :param args: (hbar, gamma, npairs, dates, model_types, max_range) of the chunk
+    :return: list of (date, sill, range, type) of the best fitting model of every time step
+    """
+    hbar, gamma, npairs, dates, model_types, max_range = args
+    rows = []
+    previous = {}
+    for j, date in enumerate(dates):
+        best = None
+        for model_type in model_types:
+            fit = fit_model(hbar[:, j], gamma[:, j], npairs[:, j], model_type,
+                            previous.get(model_type), max_range)
+            if fit is None:
+                continue
+            previous[model_type] = fit[:2]
+            if best is None or fit[2] < best[2]:
+                best = fit + (model_type,)
+        if best is not None:
+            rows.append((date, best[0], best[1], best[3]))
+    return rows
+
+
+def non_zero_columns(df):
+    # time steps with rain anywhere, like non_zero_columns in the R script
+    a = df.iloc[:, 4:]
+    return a.columns[a.sum() != 0].tolist()
+
+
+def fit_variograms(df, model_types=('Spherical',), processes=None, chunk_size=200):
+    """
+    fit a variogram model to every non-zero time step of a wide table. the experimental
+    variograms of a chunk of time steps are computed together and the chunks are fit in parallel
+    :param df: wide table (site_name, x, y, src, one column per time step)
+    :param model_types: models to try ('Spherical' and/or 'Exponential'); the one with the
+    smallest weighted sum of squares is kept
+    :param processes: size of the pool (number of cpus by default)
+    :param chunk_size: time steps per chunk
+    :return: data frame with 'date', 'sill', 'range', 'type' and 'nugget' columns
+    """
+    bins = LagBins(GaugeNetwork.from_frame(df))
+    max_range = 2 * bins.lag * bins.nlag
+    dates = non_zero_columns(df)
+    chunks = []
+    for s in range(0, len(dates), chunk_size):
+        chunk_dates = dates[s:s + chunk_size]
+        hbar, gamma, npairs = bins.experimental(df[chunk_dates].values.astype(float))
+        chunks.append((hbar, gamma, npairs, chunk_dates, list(model_types), max_range))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(fit_time_steps, chunks)
+        pool.close()
+    finally:
+        pool.join()
+    rows = [r for chunk_rows in results for r in chunk_rows]
+    print 'fit {} of {} time steps'.format(len(rows), len(dates))
+    param_df = pd.DataFrame(rows, columns=['date', 'sill', 'range', 'type'])
+    param_df['nugget'] = 0.
+    return param_df
+
+
+def update_model_params(table, model_types=('Spherical',), processes=None):
+    """
+    fit the variograms of a wide table and write them to '<table>_model_params', the table that
+    ModelParams and kriging.read_model_params read
+    :param table: e.g. 'hr_zeroes'
+    """
+    param_df = fit_variograms(get_data_frame_from_table(table), model_types, processes)
+    update_table('{}_model_params'.format(table), param_df.set_index('date'))
+    return param_df
+
+
+if __name__ == '__main__':
+    update_model_params('hr_zeroes')
@@ -0,0 +1,138 @@
+# Purpose: Zonal means of raster stacks under the watershed polygons, using a sparse
+# (watershed x cell) weight matrix that is rasterized once per grid and cached on disk
+
+import os
+import hashlib
+import numpy as np
+import shapefile
+from matplotlib.path import Path
+from scipy import sparse
+from storm_stats_functions import data_dir, check_dir
+from kriging import Grid
+
+cache_dir = os.path.join(data_dir, 'cache', 'zonal_weights')
+
+# weight matrices and records by key, shared by all calls of a process (see get_zonal_weights)
+_weights = {}
+
+
+def read_polygons(shp):
+    """
+    :param shp: polygon shapefile (e.g. problem_watersheds.shp)
+    :return: list with the rings (matplotlib Paths) of every feature in FID order and list of
+    attribute dicts
+    """
+    sf = shapefile.Reader(shp)
+    field_names = [f[0] for f in sf.fields[1:]]
+    polygons = []
+    for shape in sf.shapes():
+        parts = list(shape.parts) + [len(shape.points)]
+        polygons.append([Path(np.array(shape.points[s:e], dtype=float))
+                         for s, e in zip(parts[:-1], parts[1:])])
+    records = [dict(zip(field_names, r)) for r in sf.records()]
+    return polygons, records
+
+
+def contains_points(rings, points):
+    # even-odd rule over the rings, so points in holes are outside
+    inside = np.zeros(len(points), dtype=bool)
+    for ring in rings:
+        inside ^= ring.contains_points(points)
+    return inside
+
+
+def coverage_weights(polygons, grid, supersample=5):
+    """
+    fraction of every cell covered by every polygon, estimated from supersample x supersample
+    points per cell. each row is normalized to sum to 1, so a row gives the area-weighted mean
+    :return: csr matrix of shape (number of polygons, grid.size)
+    """
+    offsets = (np.arange(supersample) + 0.5) / supersample
+    rows, cols, vals = [], [], []
+    for i, rings in enumerate(polygons):
+        vertices = np.vstack([ring.vertices for ring in rings])
+        xmin, ymin = vertices.min(axis=0)
+        xmax, ymax = vertices.max(axis=0)
+        c0 = max(int(np.floor((xmin - grid.xmin) / grid.cell_size)), 0)
+        c1 = min(int(np.ceil((xmax - grid.xmin) / grid.cell_size)), grid.ncols)
+        r0 = max(int(np.floor((grid.ymax - ymax) / grid.cell_size)), 0)
+        r1 = min(int(np.ceil((grid.ymax - ymin) / grid.cell_size)), grid.nrows)
+        if c1 <= c0 or r1 <= r0:
+            continue
+
+        # sub-cell points of the cells in the polygon's bounding box
+        sub_x = grid.xmin + (np.arange(c0, c1)[:, np.newaxis] + offsets).ravel() * grid.cell_size
+        sub_y = grid.ymax - (np.arange(r0, r1)[:, np.newaxis] + offsets).ravel() * grid.cell_size
+        xx, yy = np.meshgrid(sub_x, sub_y)
+        inside = contains_points(rings, np.column_stack([xx.ravel(), yy.ravel()]))
+        inside = inside.reshape(r1 - r0, supersample, c1 - c0, supersample)
+        frac = inside.mean(axis=(1, 3))
+        r, c = np.nonzero(frac)
+        rows.append(np.full(len(r), i))
+        cols.append((r + r0) * grid.ncols + c + c0)
+        vals.append(frac[r, c])
+    if rows:
+        rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    weights = sparse.csr_matrix((vals, (rows, cols)), shape=(len(polygons), grid.size))
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    row_sums[row_sums == 0] = 1.
+    return sparse.diags(1. / row_sums).dot(weights).tocsr()
+
+
+def cache_file(shp, grid, supersample, dty=cache_dir):
+    key = repr((os.path.abspath(shp), os.path.getmtime(shp), grid.key(), supersample))
+    return os.path.join(dty, 'weights_{}.npz'.format(hashlib.md5(key).hexdigest()))
+
+
+def get_zonal_weights(shp, grid=None, supersample=5, dty=cache_dir):
+    """
+    the (polygon x cell) weight matrix of a shapefile on a grid, from memory or the disk cache if
+    it was built before for the same shapefile (path and mtime), grid and supersampling
+    :return: csr weight matrix and list of the polygon attribute dicts
+    """
+    grid = grid or Grid()
+    key = (os.path.abspath(shp), os.path.getmtime(shp), grid.key(), supersample)
+    if key in _weights:
+        return _weights[key]
+    polygons, records = read_polygons(shp)
+    f = cache_file(shp, grid, supersample, dty)
+    if os.path.exists(f):
+        npz = np.load(f)
+        weights = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                                    shape=tuple(npz['shape']))
+    else:
+        weights = coverage_weights(polygons, grid, supersample)
+        check_dir(dty)
+        np.savez(f, data=weights.data, indices=weights.indices, indptr=weights.indptr,
+                 shape=weights.shape)
+    _weights[key] = weights, records
+    return weights, records
+
+
+def zonal_means(weights, stack):
+    """
+    mean of every raster of a stack under every polygon with one sparse product. NaN (NoData)
+    cells are left out of the mean, like the "DATA" option of ZonalStatisticsAsTable
+    :param weights: (polygon x cell) weight matrix (see get_zonal_weights)
+    :param stack: (time x cell) or (time x rows x cols) array, or a single raster
+    :return: (time x polygon) array of means (NaN where a polygon has no data)
+    """
+    stack = np.asarray(stack, dtype=float)
+    if stack.ndim == 1 or (stack.ndim == 2 and stack.shape[1] != weights.shape[1]):
+        stack = stack[np.newaxis]
+    stack = stack.reshape(len(stack), -1)
+    finite = np.isfinite(stack)
+    num = weights.dot(np.where(finite, stack, 0.).T)
+    den = weights.dot(finite.T.astype(float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (num / den).T
+
+
+def polygon_targets(weights, i, grid=None):
+    """
+    :return: cell centers and weights of polygon i, e.g. as the targets of
+    kriging.leave_nearest_out
+    """
+    grid = grid or Grid()
+    row = weights.getrow(i)
+    return grid.cell_centers()[row.indices], row.data